@@ -0,0 +1,70 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures what the ContextVarsScopeManager adds to an await, and to a
+traced coroutine call. Requires Python 3.7+.
+
+    PYTHONPATH=. python benchmarks/bench_asyncio.py
+"""
+
+import asyncio
+import time
+
+from tracing import ConstSampler, Tracer
+from tracing.contextvars_scope_manager import ContextVarsScopeManager
+from tracing.reporter import NullReporter
+
+NUMBER = 100000
+
+tracer = Tracer(client=None, service_name='bench', reporter=NullReporter(),
+                sampler=ConstSampler(True),
+                scope_manager=ContextVarsScopeManager())
+
+
+async def plain():
+    pass
+
+
+traced = tracer.trace('traced')(plain)
+
+
+async def awaits():
+    for _ in range(NUMBER):
+        await asyncio.sleep(0)
+
+
+async def calls(func):
+    for _ in range(NUMBER):
+        await func()
+
+
+async def usec(coro):
+    start = time.perf_counter()
+    await coro
+    return (time.perf_counter() - start) / NUMBER * 1e6
+
+
+async def main():
+    no_span = await usec(awaits())
+    with tracer.start_active_span('bench'):
+        in_span = await usec(awaits())
+    print('await asyncio.sleep(0)   %6.3f us, %6.3f us in an active span'
+          % (no_span, in_span))
+    print('await coroutine()        %6.3f us, %6.3f us traced'
+          % (await usec(calls(plain)), await usec(calls(traced))))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the span record encoding with the repr() the reporter used to
+store, and measures decoding and batching.
+
+    PYTHONPATH=. python benchmarks/bench_encoding.py
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from tracing import ConstSampler, Tracer, encoding, thrift
+from tracing.reporter import NullReporter
+
+NUMBER = 20000
+
+
+def make_span(tracer):
+    span = tracer.start_span('get_user', tags={
+        'http.url': 'http://users.local/user/12345',
+        'http.method': 'GET',
+        'component': 'requests',
+        'retries': 2,
+    })
+    span.log_kv({'event': 'cache-miss', 'key': 'user:12345'})
+    span.finish()
+    return span
+
+
+def usec(func, number=NUMBER):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    tracer = Tracer(client=None, service_name='bench', reporter=NullReporter(),
+                    sampler=ConstSampler(True))
+    span = make_span(tracer)
+    record = encoding.encode_span(span)
+    process_record = encoding.encode_process(thrift.make_process(
+        service_name='bench', tags=tracer.tags, max_length=1024))
+    records = [record] * 50
+    envelope = encoding.encode_batch(process_record, records)
+
+    print('repr(span)                %6.2f us  %4d bytes, no tags or logs'
+          % (usec(lambda: '%s' % span), len('%s' % span)))
+    print('encode_span(span)         %6.2f us  %4d bytes'
+          % (usec(lambda: encoding.encode_span(span)), len(record)))
+    print('decode_span(record)       %6.2f us'
+          % usec(lambda: encoding.decode_span(record)))
+    print('decode_span, no tags      %6.2f us'
+          % usec(lambda: encoding.decode_span(record, with_tags=False)))
+    print('encode_batch, 50 spans    %6.2f us  %4d bytes'
+          % (usec(lambda: encoding.encode_batch(process_record, records),
+                  number=2000), len(envelope)))
+    print('decode_batch, 50 spans    %6.2f us'
+          % usec(lambda: encoding.decode_batch(envelope), number=200))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures the cost of a span ID, and counts duplicate IDs drawn by pre-fork
+workers that all generate IDs at the same time. The first row is the
+formatted time and IP address the tracer used before ID generators.
+
+    PYTHONPATH=. python benchmarks/bench_id_generator.py
+"""
+
+from __future__ import print_function
+
+import multiprocessing
+import time
+import timeit
+
+from tracing.id_generator import RandomIdGenerator, TimeOrderedIdGenerator
+
+NUMBER = 200000
+WORKERS = 16
+IDS_PER_WORKER = 100000
+
+
+def usec(func, number=NUMBER):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+class FormattedIdGenerator(object):
+    """The former span ID: seconds followed by the host's IP address."""
+
+    def __init__(self, ipl=3232235786):  # 192.168.1.10
+        self.ipl = ipl
+
+    def new_id(self):
+        return int('%10.0f%010d' % (time.time(), self.ipl))
+
+    def reset(self):
+        pass
+
+    def __str__(self):
+        return 'FormattedIdGenerator()'
+
+
+GENERATORS = [FormattedIdGenerator(), RandomIdGenerator(),
+              TimeOrderedIdGenerator()]
+
+
+def worker(args):
+    index, start = args
+    # a forked worker re-seeds the generator it inherited, as the tracer does
+    generator = GENERATORS[index]
+    generator.reset()
+    # all workers start on the same millisecond
+    start.wait()
+    return [generator.new_id() for _ in range(IDS_PER_WORKER)]
+
+
+def duplicates(index):
+    manager = multiprocessing.Manager()
+    start = manager.Event()
+    pool = multiprocessing.Pool(WORKERS)
+    result = pool.map_async(worker, [(index, start)] * WORKERS)
+    start.set()
+    ids = [i for batch in result.get() for i in batch]
+    pool.close()
+    pool.join()
+    manager.shutdown()
+    return len(ids) - len(set(ids))
+
+
+def main():
+    for index, generator in enumerate(GENERATORS):
+        print('%-26s %5.3f us per ID, %d duplicates in %d IDs of %d workers'
+              % (generator, usec(generator.new_id), duplicates(index),
+                 WORKERS * IDS_PER_WORKER, WORKERS))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures entering and exiting an unsampled scope with start_active_span(),
+and a call of a function decorated with trace(), next to a plain
+start_span() and finish() and to two attribute lookups.
+
+    PYTHONPATH=. python benchmarks/bench_scope.py
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from tracing import ConstSampler, Tracer
+from tracing.reporter import NullReporter
+
+NUMBER = 200000
+
+
+class Holder(object):
+    def __init__(self, value=None):
+        self.value = value
+
+
+def usec(func):
+    return min(timeit.repeat(func, number=NUMBER, repeat=5)) / NUMBER * 1e6
+
+
+def main():
+    tracer = Tracer(client=None, service_name='bench', reporter=NullReporter(),
+                    sampler=ConstSampler(False))
+    holder = Holder(Holder())
+
+    def lookups():
+        return holder.value.value
+
+    def plain():
+        tracer.start_span('op').finish()
+
+    def scoped():
+        with tracer.start_active_span('op'):
+            pass
+
+    def function():
+        pass
+
+    traced = tracer.trace('op')(function)
+
+    print('unsampled, %d times' % NUMBER)
+    print('two attribute lookups        %6.3f us' % usec(lookups))
+    print('start_span() and finish()    %6.3f us' % usec(plain))
+    print('start_active_span()          %6.3f us' % usec(scoped))
+    with tracer.start_active_span('parent'):
+        print('start_span(), child          %6.3f us' % usec(plain))
+        print('start_active_span(), child   %6.3f us' % usec(scoped))
+    print('function()                   %6.3f us, %6.3f us traced'
+          % (usec(function), usec(traced)))
+
+
+if __name__ == '__main__':
+    main()
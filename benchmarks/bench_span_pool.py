@@ -0,0 +1,106 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares starting, tagging and reporting spans with and without a
+SpanPool: the time per span, the share of spans taken from the pool, the
+peak memory traced while running and the garbage collections run. Spans are encoded and handed back to the pool in
+batches, as the Reporter's flusher does.
+
+    PYTHONPATH=. python benchmarks/bench_span_pool.py
+"""
+
+from __future__ import print_function
+
+import gc
+import time
+
+from tracing import ConstSampler, SpanPool, Tracer, encoding
+from tracing.reporter import NullReporter
+
+SPANS = 100000
+REPEAT = 5
+BATCH_SIZE = 100
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+
+class BatchReporter(NullReporter):
+    """Encodes spans in batches and recycles them, like Reporter."""
+
+    def __init__(self):
+        self.spans = []
+        self.recycled = 0
+
+    def report_span(self, span):
+        self.spans.append(span)
+        if len(self.spans) >= BATCH_SIZE:
+            spans, self.spans = self.spans, []
+            for span in spans:
+                encoding.encode_span(span)
+            pool = spans[0].tracer.span_pool
+            if pool is not None:
+                self.recycled += pool.release(spans)
+
+
+def run(tracer):
+    for i in range(SPANS):
+        span = tracer.start_span('get_user', tags={'component': 'bench'})
+        span.set_tag('user.id', i)
+        span.finish()
+
+
+def collections():
+    if hasattr(gc, 'get_stats'):
+        return sum(stat['collections'] for stat in gc.get_stats())
+    return None
+
+
+def measure(span_pool):
+    reporter = BatchReporter()
+    tracer = Tracer(client=None, service_name='bench', reporter=reporter,
+                    sampler=ConstSampler(True), span_pool=span_pool)
+    run(tracer)  # warm up, fills the pool
+    gc.collect()
+    reporter.recycled = 0
+    before = collections()
+    elapsed = []
+    for _ in range(REPEAT):
+        start = time.time()
+        run(tracer)
+        elapsed.append(time.time() - start)
+    after = collections()
+    recycled = 100.0 * reporter.recycled / SPANS / REPEAT
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        run(tracer)
+        peak = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    return (min(elapsed) / SPANS * 1e6, recycled, peak,
+            None if before is None else after - before)
+
+
+def main():
+    print('%d spans, reported in batches of %d, %d times'
+          % (SPANS, BATCH_SIZE, REPEAT))
+    for name, span_pool in (('no pool', None), ('SpanPool', SpanPool())):
+        print('%-10s %6.2f us per span, %5.1f%% recycled, peak %s KiB, '
+              '%s GC runs' % ((name,) + measure(span_pool)))
+
+if __name__ == '__main__':
+    main()
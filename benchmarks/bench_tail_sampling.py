@@ -0,0 +1,99 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures what tail sampling costs over head sampling alone: the time per
+span of recording every trace for a TailSamplingReporter, and the memory
+the buffered spans of unfinished traces really take, next to the
+span_overhead they are charged.
+
+    PYTHONPATH=. python benchmarks/bench_tail_sampling.py
+"""
+
+from __future__ import print_function
+
+import timeit
+
+from tracing import Tracer
+from tracing.constants import DEFAULT_TAIL_SAMPLING_SPAN_OVERHEAD
+from tracing.reporter import NullReporter
+from tracing.sampler import ProbabilisticSampler
+from tracing.tail_sampling import ErrorPolicy, LatencyPolicy, \
+    TailSamplingReporter
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+NUMBER = 2000
+SPANS_PER_TRACE = 10
+OPEN_TRACES = 1000
+
+
+def make_tracer(tail_sampling):
+    reporter = NullReporter()
+    if tail_sampling:
+        reporter = TailSamplingReporter(
+            reporter, [LatencyPolicy(1.0), ErrorPolicy()])
+    return Tracer(client=None, service_name='bench', reporter=reporter,
+                  sampler=ProbabilisticSampler(0.001),
+                  record_all=tail_sampling)
+
+
+def finish_trace(tracer):
+    root = tracer.start_span('handle', tags={'http.method': 'GET'})
+    for _ in range(SPANS_PER_TRACE - 1):
+        span = tracer.start_span('query', child_of=root)
+        span.set_tag('db.statement', 'SELECT * FROM users WHERE id = ?')
+        span.finish()
+    root.finish()
+
+
+def usec_per_span(tracer):
+    best = min(timeit.repeat(lambda: finish_trace(tracer),
+                             number=NUMBER, repeat=5))
+    return best / NUMBER / SPANS_PER_TRACE * 1e6
+
+
+def buffered_bytes_per_span():
+    """Leave OPEN_TRACES traces without their root finished."""
+    tracer = make_tracer(True)
+    roots = [tracer.start_span('handle') for _ in range(OPEN_TRACES)]
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for root in roots:
+        for _ in range(SPANS_PER_TRACE - 1):
+            span = tracer.start_span('query', child_of=root)
+            span.set_tag('db.statement', 'SELECT * FROM users WHERE id = ?')
+            span.finish()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    grown = sum(stat.size_diff for stat in after.compare_to(before, 'lineno'))
+    return grown / float(OPEN_TRACES * (SPANS_PER_TRACE - 1))
+
+
+def main():
+    print('head sampling only   %6.2f us per span'
+          % usec_per_span(make_tracer(False)))
+    print('with tail sampling   %6.2f us per span'
+          % usec_per_span(make_tracer(True)))
+    if tracemalloc is not None:
+        print('buffered span        %6d bytes, charged %d'
+              % (buffered_bytes_per_span(),
+                 DEFAULT_TAIL_SAMPLING_SPAN_OVERHEAD))
+
+
+if __name__ == '__main__':
+    main()
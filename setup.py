@@ -21,6 +21,6 @@ setup(name='algotracing',
     description='Algohub Tracing',
     author='Ander Sun',
     author_email='zhaohui.sun@genetalks.com',
-    install_requires=['opentracing==1.3.0','future==0.16.0','six==1.11.0','tornado==4.5.3'],
+    install_requires=['opentracing==1.3.0','future==0.16.0','six==1.11.0','tornado==4.5.3','thrift==0.10.0','futures==3.2.0;python_version<"3"'],
     url='https://www.genetalks.com/',
     packages=['algotracing'])
@@ -0,0 +1,66 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from tracing import ConstSampler, Tracer
+from tracing.contextvars_scope_manager import ContextVarsScopeManager
+from tracing.utils import in_event_loop
+
+
+@pytest.fixture
+def async_tracer(reporter):
+    return Tracer(client=None, service_name='test-service', reporter=reporter,
+                  sampler=ConstSampler(True),
+                  scope_manager=ContextVarsScopeManager())
+
+
+def test_gathered_coroutines_get_their_callers_span(async_tracer):
+    tracer = async_tracer
+
+    @tracer.trace()
+    async def leaf(i):
+        await asyncio.sleep(0.001 * (3 - i))
+        return tracer.active_span
+
+    async def handler(n):
+        with tracer.start_active_span('handler-%d' % n) as scope:
+            spans = await asyncio.gather(*[leaf(i) for i in range(3)])
+            assert tracer.active_span is scope.span
+            return scope.span, spans
+
+    async def main():
+        results = await asyncio.gather(*[handler(n) for n in range(5)])
+        assert tracer.active_span is None
+        return results
+
+    for parent, children in asyncio.run(main()):
+        assert [child.parent_id for child in children] == [parent.span_id] * 3
+
+
+def test_coroutine_needs_contextvars_scope_manager(tracer):
+    with pytest.raises(ValueError):
+        @tracer.trace()
+        async def handler():
+            pass
+
+
+def test_in_event_loop():
+    async def probe():
+        return in_event_loop()
+
+    assert not in_event_loop()
+    assert asyncio.run(probe())
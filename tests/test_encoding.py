@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import opentracing
+import pytest
+import six
+
+from tracing import encoding, thrift
+from tracing.span_context import SpanContext
+from tracing.thrift import SpanRefType, TagType
+
+
+def test_span_round_trip(tracer):
+    parent = tracer.start_span('parent')
+    span = tracer.start_span('get_user',
+                             references=opentracing.child_of(parent),
+                             tags={'http.url': 'http://host/user/1'},
+                             start_time=1500000000.25)
+    span.set_tag('retries', 3)
+    span.log_kv({'event': 'cache-miss'}, timestamp=1500000000.5)
+    span.finish(finish_time=1500000001.75)
+
+    record = encoding.decode_span(encoding.encode_span(span))
+
+    assert record.trace_id == span.trace_id
+    assert record.span_id == span.span_id
+    assert record.parent_id == parent.span_id
+    assert record.flags == span.flags
+    assert record.operation_name == 'get_user'
+    assert record.start_time == 1500000000.25
+    assert record.end_time == 1500000001.75
+    assert [(ref.refType, ref.traceId, ref.spanId)
+            for ref in record.references] == \
+        [(SpanRefType.CHILD_OF, parent.trace_id, parent.span_id)]
+    tags = dict((tag.key, tag) for tag in record.tags)
+    assert tags['http.url'].vStr == 'http://host/user/1'
+    assert tags['retries'].vLong == 3
+    assert len(record.logs) == 1
+    assert record.logs[0]['timestamp'] == 1500000000500000
+    assert [(f.key, f.vStr) for f in record.logs[0]['fields']] == \
+        [('event', 'cache-miss')]
+
+
+def test_root_span_has_no_parent(tracer):
+    span = tracer.start_span('root')
+    span.finish()
+    record = encoding.decode_span(encoding.encode_span(span))
+    assert record.parent_id is None
+    assert record.references == []
+
+
+def test_debug_id_reference_is_skipped(tracer):
+    parent = tracer.start_span('parent')
+    debug = SpanContext.with_debug_id('debug-1')
+    span = tracer.start_span('child', references=[
+        opentracing.child_of(debug), opentracing.follows_from(parent)])
+    span.finish()
+    record = encoding.decode_span(encoding.encode_span(span))
+    assert [(ref.refType, ref.traceId, ref.spanId)
+            for ref in record.references] == \
+        [(SpanRefType.FOLLOWS_FROM, parent.trace_id, parent.span_id)]
+
+
+def test_decode_without_tags(tracer):
+    span = tracer.start_span('op', tags={'a': 'b'})
+    span.finish()
+    record = encoding.decode_span(encoding.encode_span(span), with_tags=False)
+    assert record.operation_name == 'op'
+    assert record.tags is None
+    assert record.logs is None
+
+
+def test_tag_values_are_truncated(tracer):
+    span = tracer.start_span('op', tags={'long': 'x' * 10000})
+    span.finish()
+    record = encoding.decode_span(encoding.encode_span(span))
+    value = [tag.vStr for tag in record.tags if tag.key == 'long'][0]
+    assert value == 'x' * tracer.max_tag_value_length
+
+
+def test_non_ascii_strings(tracer):
+    span = tracer.start_span(u'café', tags={u'kë': u'väl'})
+    span.finish()
+    record = encoding.decode_span(encoding.encode_span(span))
+    assert record.operation_name == u'café'
+    assert [tag.vStr for tag in record.tags if tag.key == u'kë'] == [u'väl']
+
+
+def test_unprintable_tag_values(tracer):
+    class Value(object):
+        def __str__(self):
+            return 'caf\xc3\xa9' if six.PY2 else u'café'
+
+    tags = {'object': Value(), 'cut': u'é' * 10000}
+    if six.PY2:
+        tags['bytes'] = b'caf\xe9'
+    span = tracer.start_span('op', tags=tags)
+    span.finish()
+    record = encoding.decode_span(encoding.encode_span(span))
+    values = dict((tag.key, tag.vStr) for tag in record.tags)
+    assert values['object'] == u'café'
+    assert values['cut'] == u'é' * tracer.max_tag_value_length
+    if six.PY2:
+        assert values['bytes'] == u'caf\ufffd'
+
+
+def test_failing_tag_values_and_non_string_keys(tracer):
+    class Broken(object):
+        def __str__(self):
+            raise ValueError('no str')
+
+        def __repr__(self):
+            return 'Broken()'
+
+    class Hopeless(Broken):
+        def __repr__(self):
+            raise ValueError('no repr')
+
+    span = tracer.start_span('op')
+    span.set_tag('broken', Broken())
+    span.set_tag('hopeless', Hopeless())
+    span.set_tag(1, 'x')
+    span.finish()
+    record = encoding.decode_span(encoding.encode_span(span))
+    values = dict((tag.key, tag.vStr) for tag in record.tags)
+    assert values['broken'] == u'Broken()'
+    assert values['hopeless'] == u'<unprintable Hopeless>'
+    assert values[u'1'] == u'x'
+
+
+@pytest.mark.parametrize('value', [
+    0, 1, 127, 128, 300, 2 ** 32, 2 ** 63 - 1, 2 ** 64 - 1, 2 ** 127 + 5])
+def test_varint_round_trip(value):
+    buf = bytearray()
+    encoding._write_varint(buf, value)
+    assert encoding._read_varint(buf, 0) == (value, len(buf))
+
+
+@pytest.mark.parametrize('value', [0, 1, -1, 2 ** 63 - 1, -2 ** 63])
+def test_zigzag_round_trip(value):
+    assert encoding._unzigzag(encoding._zigzag(value)) == value
+
+
+def test_version_1_record_is_decoded():
+    buf = bytearray([encoding.SPAN_RECORD_VERSION_1])
+    for value in (7, 8, 0, 1, 1500000000000000, 250):
+        encoding._write_varint(buf, value)
+    encoding._write_str(buf, u'op')
+    section = bytearray([0, 0])
+    encoding._write_varint(buf, len(section))
+    buf.extend(section)
+
+    record = encoding.decode_span(bytes(buf))
+
+    assert (record.trace_id, record.span_id, record.parent_id) == (7, 8, None)
+    assert record.operation_name == 'op'
+    assert record.references == []
+    assert record.end_time - record.start_time == pytest.approx(0.00025, abs=1e-6)
+
+
+def test_unsupported_record_version():
+    with pytest.raises(ValueError):
+        encoding.decode_span(b'\x7f')
+
+
+def _process_record():
+    process = thrift.make_process(
+        service_name='svc', tags={'algo.hostname': 'host-1'},
+        max_length=1024)
+    return encoding.encode_process(process)
+
+
+def test_batch_round_trip(tracer):
+    spans = [tracer.start_span('op-%d' % i) for i in range(3)]
+    for span in spans:
+        span.finish()
+    records = [encoding.encode_span(span) for span in spans]
+
+    envelope = encoding.encode_batch(_process_record(), records)
+    process, decoded = encoding.decode_batch(envelope)
+
+    assert process.serviceName == 'svc'
+    assert [(tag.key, tag.vType, tag.vStr) for tag in process.tags] == \
+        [('algo.hostname', TagType.STRING, 'host-1')]
+    assert [record.span_id for record in decoded] == \
+        [span.span_id for span in spans]
+    assert encoding.batch_records(envelope) == records
+
+
+def test_empty_batch():
+    process, spans = encoding.decode_batch(
+        encoding.encode_batch(_process_record(), []))
+    assert process.serviceName == 'svc'
+    assert spans == []
+
+
+@pytest.mark.parametrize('use_dict', [
+    False,
+    pytest.param(True, marks=pytest.mark.skipif(
+        not encoding.ZDICT_SUPPORTED, reason='zlib dictionaries need 3.3+')),
+])
+def test_compressed_batch_round_trip(tracer, use_dict):
+    spans = [tracer.start_span('op', tags={'component': 'test'})
+             for _ in range(20)]
+    for span in spans:
+        span.finish()
+    records = [encoding.encode_span(span) for span in spans]
+    envelope = encoding.encode_batch(_process_record(), records)
+
+    compressed = encoding.compress_batch(envelope, use_dict=use_dict)
+
+    assert six.indexbytes(compressed, 0) == (
+        encoding.BATCH_ZLIB_DICT if use_dict else encoding.BATCH_ZLIB)
+    assert len(compressed) < len(envelope)
+    assert encoding.batch_records(compressed) == records
+    assert len(encoding.decode_batch(compressed)[1]) == 20
+
+
+def test_unsupported_batch_version():
+    with pytest.raises(ValueError):
+        encoding.decode_batch(b'\x7f')
@@ -0,0 +1,67 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import threading
+
+from tracing.id_generator import TimeOrderedIdGenerator
+
+
+def new_ids(count, generator=TimeOrderedIdGenerator()):
+    # runs in a forked worker, which re-seeds the inherited generator
+    generator.reset()
+    return [generator.new_id() for _ in range(count)]
+
+
+def test_ids_increase_by_millisecond():
+    generator = TimeOrderedIdGenerator()
+    ids = [generator.new_id() for _ in range(10000)]
+    assert len(set(ids)) == len(ids)
+    millis = [i >> 23 for i in ids]
+    assert millis == sorted(millis)
+    assert all(0 < i < 1 << 64 for i in ids)
+
+
+def test_ids_are_unique_across_threads():
+    generator = TimeOrderedIdGenerator()
+    ids = []
+
+    def run():
+        ids.extend([generator.new_id() for _ in range(5000)])
+
+    threads = [threading.Thread(target=run) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(set(ids)) == 8 * 5000
+
+
+def test_consecutive_pids_get_distinct_nodes(monkeypatch):
+    nodes = set()
+    for pid in range(40000, 48192):
+        monkeypatch.setattr('os.getpid', lambda: pid)
+        nodes.add(TimeOrderedIdGenerator()._node)
+    assert len(nodes) == 8192
+
+
+def test_ids_are_unique_across_forked_workers():
+    pool = multiprocessing.get_context('fork').Pool(8)
+    try:
+        batches = pool.map(new_ids, [20000] * 8)
+    finally:
+        pool.close()
+        pool.join()
+    ids = [i for batch in batches for i in batch]
+    assert len(set(ids)) == len(ids)
@@ -0,0 +1,494 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from tracing import ConstSampler, Tracer, encoding
+from tracing import reporter as reporter_module
+from tracing.metrics import Metrics
+from tracing.reporter import InMemoryReporter, Reporter
+from tracing.spill import SpillBuffer
+
+
+def test_stagedb_mode_does_not_import_thrift():
+    script = '\n'.join([
+        'import sys',
+        'from tracing import Config',
+        'Config({}, service_name="svc")._create_local_agent_channel()',
+        'assert "thrift.transport" not in sys.modules, "thrift imported"',
+    ])
+    subprocess.check_call([sys.executable, '-c', script])
+
+
+class BlockingClient(object):
+    """A stagedb client whose writes wait until release() is called."""
+
+    def __init__(self, block_put=True):
+        self.block_put = block_put
+        self.released = threading.Event()
+        self.data = {}
+        self.callbacks = []
+
+    def put(self, key, value):
+        if self.block_put:
+            self.released.wait(5)
+        self.data[key] = value
+
+    def async_put(self, key, value, callback):
+        self.data[key] = value
+        self.callbacks.append(callback)
+
+    def release(self):
+        self.released.set()
+        for callback in self.callbacks:
+            callback({'reason': 'ok', 'ret': None})
+
+
+def make_metrics(counts):
+    def count(key, value):
+        counts[key] = counts.get(key, 0) + value
+    return Metrics(count=count)
+
+
+def make_tracer(reporter):
+    return Tracer(client=None, service_name='svc', reporter=reporter,
+                  sampler=ConstSampler(True))
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.001)
+
+
+def spilled_spans(spill):
+    # close() flushed and unmapped the ring, read it back from its file
+    spill = SpillBuffer(path=spill.path, size=spill.size)
+    spans = 0
+    while len(spill):
+        _, value, count = reporter_module._unpack_spill_entry(spill.peek())
+        assert len(encoding.decode_batch(value)[1]) == count
+        spans += count
+        spill.pop()
+    return spans
+
+
+def test_overflow_is_spilled_by_the_flusher(tmp_path):
+    client = BlockingClient()
+    spill = SpillBuffer(path=str(tmp_path / 'spill'), size=1 << 20)
+    reporter = Reporter(client, queue_capacity=2, batch_size=1,
+                        flush_interval=0.01, spill=spill)
+    tracer = make_tracer(reporter)
+    tracer.start_span('first').finish()
+    wait_for(lambda: reporter._flushing == 1)
+
+    for _ in range(5):
+        tracer.start_span('op').finish()
+
+    # the caller only queues the spans that do not fit, up to
+    # queue_capacity of them, and drops the rest
+    assert len(reporter._queue) == 2
+    assert len(reporter._overflow) == 2
+    assert len(spill) == 0
+
+    client.release()
+    result = reporter.close().result(5)
+    # spilled spans may be replayed by the time the reporter is closed
+    assert len(client.data) + spilled_spans(spill) == 5
+    assert result.abandoned == 0
+
+
+def start_full_reporter(overflow_policy, counts, **kwargs):
+    """
+    :return: Returns a reporter whose flusher waits for the client with
+        the 'first' span, and whose queue holds 'a' and 'b'.
+    """
+    client = BlockingClient()
+    reporter = Reporter(client, queue_capacity=2, batch_size=1,
+                        flush_interval=0.01, overflow_policy=overflow_policy,
+                        metrics=make_metrics(counts), **kwargs)
+    tracer = make_tracer(reporter)
+    tracer.start_span('first').finish()
+    wait_for(lambda: reporter._flushing == 1)
+    tracer.start_span('a').finish()
+    tracer.start_span('b').finish()
+    return client, reporter, tracer
+
+
+def queued(reporter):
+    return [span.operation_name for span in reporter._queue]
+
+
+@pytest.mark.parametrize('overflow_policy,expected', [
+    (reporter_module.OVERFLOW_DROP_NEWEST, ['a', 'b']),
+    (reporter_module.OVERFLOW_DROP_OLDEST, ['b', 'c']),
+])
+def test_overflow_drops_one_end_of_the_queue(overflow_policy, expected):
+    counts = {}
+    client, reporter, tracer = start_full_reporter(overflow_policy, counts)
+    tracer.start_span('c').finish()
+    assert queued(reporter) == expected
+    assert counts['algo.spans.dropped_true'] == 1
+
+    client.release()
+    assert reporter.close().result(5).abandoned == 0
+    assert len(client.data) == 3
+
+
+def test_overflow_block_waits_for_room():
+    counts = {}
+    client, reporter, tracer = start_full_reporter(
+        reporter_module.OVERFLOW_BLOCK, counts, block_timeout=5)
+    threading.Timer(0.05, client.release).start()
+    started = time.time()
+    tracer.start_span('c').finish()
+    assert time.time() - started >= 0.04
+    assert 'algo.spans.dropped_true' not in counts
+    assert reporter.close().result(5).abandoned == 0
+    assert len(client.data) == 4
+
+
+def test_overflow_block_times_out():
+    counts = {}
+    client, reporter, tracer = start_full_reporter(
+        reporter_module.OVERFLOW_BLOCK, counts, block_timeout=0.05)
+    started = time.time()
+    tracer.start_span('c').finish()
+    assert time.time() - started >= 0.05
+    assert queued(reporter) == ['a', 'b']
+    assert counts['algo.spans.dropped_true'] == 1
+
+    client.release()
+    assert reporter.close().result(5).abandoned == 0
+    assert len(client.data) == 3
+
+
+def test_overflow_drop_non_debug_keeps_debug_spans():
+    counts = {}
+    client, reporter, tracer = start_full_reporter(
+        reporter_module.OVERFLOW_DROP_NON_DEBUG, counts)
+    debug = tracer.start_span('debug', tags={'sampling.priority': 1})
+    assert debug.is_debug()
+    debug.finish()
+    assert queued(reporter) == ['b', 'debug']
+    tracer.start_span('c').finish()
+    assert queued(reporter) == ['b', 'debug']
+    tracer.start_span('d', tags={'sampling.priority': 1}).finish()
+    assert queued(reporter) == ['debug', 'd']
+    # without a non-debug span left to drop, the reported one is dropped
+    tracer.start_span('e', tags={'sampling.priority': 1}).finish()
+    assert queued(reporter) == ['debug', 'd']
+    assert counts['algo.spans.dropped_true'] == 4
+
+    client.release()
+    assert reporter.close().result(5).abandoned == 0
+    assert len(client.data) == 3
+
+
+def test_full_inflight_window_spills(tmp_path):
+    client = BlockingClient(block_put=False)
+    counts = {}
+    spill = SpillBuffer(path=str(tmp_path / 'spill'), size=1 << 20)
+    reporter = Reporter(client, batch_size=1, flush_interval=0.01,
+                        max_inflight=1, inflight_timeout=0.01, spill=spill,
+                        metrics=make_metrics(counts))
+    tracer = make_tracer(reporter)
+    for _ in range(3):
+        tracer.start_span('op').finish()
+    wait_for(lambda: counts.get('algo.spans.spilled_true') == 2)
+    assert 'algo.spans.dropped_true' not in counts
+
+    client.release()
+    reporter.close().result(5)
+    assert len(client.data) + spilled_spans(spill) == 3
+
+
+class DelayedClient(object):
+    """A stagedb client that replies to async_put from another thread."""
+
+    def __init__(self):
+        self.data = {}
+
+    def async_put(self, key, value, callback):
+        self.data[key] = value
+        timer = threading.Timer(0.001, callback, [{'reason': 'ok'}])
+        timer.daemon = True
+        timer.start()
+
+
+def test_close_on_io_loop_drains_a_full_window():
+    ioloop = pytest.importorskip('tornado.ioloop')
+    io_loop = ioloop.IOLoop()
+    loop_thread = threading.Thread(target=io_loop.start)
+    loop_thread.daemon = True
+    loop_thread.start()
+    client = DelayedClient()
+    reporter = Reporter(client, batch_size=1, flush_interval=10,
+                        max_inflight=1, io_loop=io_loop)
+    tracer = make_tracer(reporter)
+    for _ in range(30):
+        tracer.start_span('op').finish()
+    result = reporter.close(3).result(5)
+    io_loop.add_callback(io_loop.stop)
+    loop_thread.join(5)
+    io_loop.close()
+    assert result.flushed == 30
+    assert result.abandoned == 0
+    assert len(client.data) == 30
+
+
+class FailingClient(object):
+    def put(self, key, value):
+        raise IOError('stagedb is down')
+
+
+def test_failed_writes_are_abandoned():
+    counts = {}
+    reporter = Reporter(FailingClient(), batch_size=2, flush_interval=0.01,
+                        metrics=make_metrics(counts))
+    tracer = make_tracer(reporter)
+    for _ in range(5):
+        tracer.start_span('op').finish()
+    result = reporter.close().result(5)
+    assert result.flushed == 0
+    assert result.abandoned == 5
+    assert counts['algo.spans.reported_false'] == 5
+
+
+def test_unencodable_spans_are_abandoned():
+    counts = {}
+    client = BlockingClient(block_put=False)
+    reporter = Reporter(client, batch_size=2, flush_interval=0.01,
+                        metrics=make_metrics(counts))
+    tracer = make_tracer(reporter)
+    for i in range(5):
+        span = tracer.start_span('op')
+        if i == 2:
+            # log fields must be a dict
+            span.log_kv(['not', 'a', 'dict'])
+        span.finish()
+    result = reporter.close().result(5)
+    assert result.flushed == 4
+    assert result.abandoned == 1
+    assert counts['algo.spans.reported_false'] == 1
+
+
+def test_close_flushes_the_spill(tmp_path):
+    spill = SpillBuffer(path=str(tmp_path / 'spill'), size=1 << 20)
+    reporter = Reporter(FailingClient(), batch_size=2, flush_interval=0.01,
+                        spill=spill)
+    tracer = make_tracer(reporter)
+    for _ in range(5):
+        tracer.start_span('op').finish()
+    result = reporter.close().result(5)
+    assert result.flushed == 5
+    assert result.abandoned == 0
+    assert spill._mmap.closed
+    assert spilled_spans(spill) == 5
+
+
+def test_close_twice(tmp_path):
+    spill = SpillBuffer(path=str(tmp_path / 'spill'), size=1 << 20)
+    reporter = Reporter(FailingClient(), batch_size=2, flush_interval=0.01,
+                        spill=spill)
+    tracer = make_tracer(reporter)
+    for _ in range(3):
+        tracer.start_span('op').finish()
+    first = tracer.close()
+    assert tracer.close() is first
+    assert first.result(5).flushed == 3
+    assert tracer.close().result(5).flushed == 3
+    spill.close()
+    assert spilled_spans(spill) == 3
+
+
+def run_in_child(target):
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            target()
+            status = 0
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    return pid
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork()')
+def test_spills_of_exited_children_are_adopted(tmp_path):
+    path = str(tmp_path / 'spill')
+    reporter = Reporter(FailingClient(), batch_size=1, flush_interval=0.01,
+                        spill=SpillBuffer(path=path, size=1 << 20))
+    tracer = make_tracer(reporter)
+
+    def crash_with_spilled_spans():
+        for _ in range(3):
+            tracer.start_span('op').finish()
+        wait_for(lambda: len(reporter.spill) == 3)
+        assert reporter.spill.path == '%s.%d' % (path, os.getpid())
+
+    def close_with_nothing_spilled():
+        assert reporter.close().result(5).abandoned == 0
+
+    closed = run_in_child(close_with_nothing_spilled)
+    assert not os.path.exists('%s.%d' % (path, closed))
+    crashed = run_in_child(crash_with_spilled_spans)
+    assert os.path.exists('%s.%d' % (path, crashed))
+    reporter.close().result(5)
+
+    # the next process on the spill path writes the crashed child's spans
+    client = BlockingClient(block_put=False)
+    reporter = Reporter(client, batch_size=1, flush_interval=0.01,
+                        spill=SpillBuffer(path=path, size=1 << 20))
+    wait_for(lambda: len(client.data) == 3)
+    reporter.close().result(5)
+    assert not os.path.exists('%s.%d' % (path, crashed))
+
+
+class TraceClient(object):
+    """
+    A stagedb client that answers async_get like stagedb, and completes
+    each async_put only when complete() is called.
+    """
+
+    def __init__(self, fail_get=False):
+        self.fail_get = fail_get
+        self.data = {}
+        self.pending = []
+
+    def put(self, key, value):
+        self.data[key] = value
+
+    def get(self, key):
+        raise AssertionError('stagedb reads go through async_get')
+
+    def async_get(self, key, callback):
+        if self.fail_get:
+            callback({'reason': 'timeout'})
+        elif key in self.data:
+            callback({'reason': 'ok', 'ret': self.data[key]})
+        else:
+            callback({'reason': 'notfound'})
+
+    def async_put(self, key, value, callback):
+        self.pending.append((key, value, callback))
+
+    def complete(self):
+        key, value, callback = self.pending.pop(0)
+        self.data[key] = value
+        callback({'reason': 'ok', 'ret': None})
+
+
+def stored_trace(client, trace_id):
+    value = client.data['/svc|trace|%x' % trace_id]
+    return sorted(encoding.decode_span(record).operation_name
+                  for record in encoding.batch_records(value))
+
+
+def finish_trace(tracer):
+    root = tracer.start_span('root')
+    tracer.start_span('child', child_of=root).finish()
+    root.finish()
+    return root
+
+
+def test_late_spans_are_merged_with_the_stored_trace():
+    client = TraceClient()
+    reporter = Reporter(client, batch_size=1, flush_interval=0.01,
+                        trace_linger=0.01, trace_cache_size=1)
+    tracer = make_tracer(reporter)
+    roots = [finish_trace(tracer), finish_trace(tracer)]
+    wait_for(lambda: len(client.data) == 2)
+    # the first trace has left the cache and is read back
+    tracer.start_span('late', child_of=roots[0]).finish()
+    reporter.close().result(5)
+    assert stored_trace(client, roots[0].trace_id) == \
+        ['child', 'late', 'root']
+    assert stored_trace(client, roots[1].trace_id) == ['child', 'root']
+
+
+def test_unreadable_trace_is_not_overwritten():
+    client = TraceClient()
+    reporter = Reporter(client, batch_size=1, flush_interval=0.01,
+                        trace_linger=0.01, trace_cache_size=1)
+    tracer = make_tracer(reporter)
+    roots = [finish_trace(tracer), finish_trace(tracer)]
+    wait_for(lambda: len(client.data) == 2)
+    client.fail_get = True
+    late = tracer.start_span('late', child_of=roots[0])
+    late.finish()
+    result = reporter.close().result(5)
+    assert stored_trace(client, roots[0].trace_id) == ['child', 'root']
+    batch = client.data['/svc|batch|%x' % late.span_id]
+    assert len(encoding.batch_records(batch)) == 1
+    assert result.abandoned == 0
+
+
+def test_pipelined_rewrite_waits_for_the_write_in_flight():
+    client = TraceClient()
+    reporter = Reporter(client, batch_size=1, flush_interval=0.01,
+                        max_inflight=4, trace_linger=0.01)
+    tracer = make_tracer(reporter)
+    root = finish_trace(tracer)
+    wait_for(lambda: len(client.pending) == 1)
+    tracer.start_span('late', child_of=root).finish()
+    key = '/svc|trace|%x' % root.trace_id
+    wait_for(lambda: reporter._trace_writes.get(key) is not None)
+    assert len(client.pending) == 1
+
+    client.complete()
+    assert stored_trace(client, root.trace_id) == ['child', 'root']
+    # the newer version is only written now
+    assert len(client.pending) == 1
+    client.complete()
+    assert stored_trace(client, root.trace_id) == ['child', 'late', 'root']
+    result = reporter.close().result(5)
+    assert result.abandoned == 0
+    assert key not in reporter._trace_writes
+
+
+def test_in_memory_reporter_evicts_renamed_spans():
+    reporter = InMemoryReporter(capacity=2)
+    tracer = make_tracer(reporter)
+    renamed = tracer.start_span('old')
+    renamed.finish()
+    renamed.set_operation_name('new')
+    for name in ('a', 'b', 'c'):
+        tracer.start_span(name).finish()
+    assert [span.operation_name for span in reporter.get_spans()] == \
+        ['b', 'c']
+    assert reporter.get_spans_by_operation('old') == []
+    assert reporter.get_spans_by_operation('new') == []
+    assert reporter.get_trace(renamed.trace_id) == []
+    c, = reporter.get_spans_by_operation('c')
+    assert reporter.get_trace(c.trace_id) == [c]
+    assert reporter.get_spans_between(0, c.start_time + 1) == \
+        reporter.get_spans()
+
+
+def test_in_memory_reporter_needs_capacity():
+    for capacity in (0, -1):
+        with pytest.raises(ValueError):
+            InMemoryReporter(capacity=capacity)
+    with pytest.raises(ValueError):
+        InMemoryReporter(time_bucket=0)
@@ -0,0 +1,57 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gc
+import weakref
+
+import pytest
+
+
+class Failure(Exception):
+    pass
+
+
+def fail(refs):
+    error = Failure('no such user')
+    refs.append(weakref.ref(error))
+    raise error
+
+
+def test_error_is_logged_without_the_exception(tracer):
+    refs = []
+    try:
+        with tracer.start_active_span('op') as scope:
+            fail(refs)
+    except Failure:
+        pass
+    span = scope.span
+    assert dict(span.tags)['error'] is True
+    (_, fields), = span.logs
+    assert fields == {
+        'event': 'error',
+        'error.kind': 'Failure',
+        'message': 'no such user',
+    }
+    gc.collect()  # the exception and the frame raising it form a cycle
+    assert refs[0]() is None
+
+
+def test_error_stack_is_logged(tracer):
+    tracer.log_error_stack = True
+    with pytest.raises(Failure):
+        with tracer.start_active_span('op') as scope:
+            fail([])
+    (_, fields), = scope.span.logs
+    assert 'in fail' in fields['stack']
+    assert "raise error" in fields['stack']
@@ -0,0 +1,71 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import weakref
+
+from tracing import ConstSampler, SpanPool, Tracer
+from tracing.reporter import Reporter
+
+
+class DictClient(object):
+    def __init__(self):
+        self.data = {}
+
+    def put(self, key, value):
+        self.data[key] = value
+
+
+def make_tracer():
+    reporter = Reporter(DictClient(), batch_size=1, flush_interval=0.01)
+    return Tracer(client=None, service_name='svc', reporter=reporter,
+                  sampler=ConstSampler(True), span_pool=SpanPool())
+
+
+def test_reported_spans_are_reused():
+    tracer = make_tracer()
+    for _ in range(10):
+        tracer.start_span('op').finish()
+    tracer.reporter.close().result(5)
+    free = list(tracer.span_pool._free)
+    assert len(free) == 10
+
+    span = tracer.start_span('again', tags={'k': 'v'})
+    assert span is free[-1]
+    assert span.operation_name == 'again'
+    assert dict(span.tags)['k'] == 'v'
+    assert span.logs == []
+
+
+def test_span_held_after_finish_is_never_reused():
+    tracer = make_tracer()
+    held = tracer.start_span('held', tags={'k': 'v'})
+    held.finish()
+    weakly_held = tracer.start_span('weakly-held')
+    weakly_held.finish()
+    ref = weakref.ref(weakly_held)
+    del weakly_held
+    for _ in range(10):
+        tracer.start_span('op').finish()
+    tracer.reporter.close().result(5)
+
+    free = tracer.span_pool._free
+    assert len(free) == 10
+    assert held not in free
+    # the pool would have kept it alive
+    assert ref() is None
+
+    spans = [tracer.start_span('new') for _ in range(20)]
+    assert held not in spans
+    assert held.operation_name == 'held'
+    assert dict(held.tags)['k'] == 'v'
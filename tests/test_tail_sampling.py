@@ -0,0 +1,124 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import pytest
+from opentracing import Format
+
+from tracing import Config, ConstSampler, Tracer
+from tracing.constants import RECORD_FLAG
+from tracing.reporter import InMemoryReporter
+from tracing.sampler import ProbabilisticSampler
+from tracing.span import Span, UnsampledSpan
+from tracing.span_context import SpanContext
+from tracing.tail_sampling import ErrorPolicy, TailSamplingReporter
+
+
+def make_tracer(sampler):
+    inner = InMemoryReporter()
+    reporter = TailSamplingReporter(inner, [ErrorPolicy()])
+    tracer = Tracer(client=None, service_name='svc', reporter=reporter,
+                    sampler=sampler, record_all=True)
+    return tracer, inner
+
+
+def finish_trace(tracer, error=False):
+    root = tracer.start_span('root')
+    child = tracer.start_span('child', child_of=root)
+    if error:
+        child.set_tag('error', True)
+    child.finish()
+    root.finish()
+    return root, child
+
+
+def test_unsampled_traces_are_recorded_but_not_propagated():
+    tracer, inner = make_tracer(ConstSampler(False))
+    root, child = finish_trace(tracer, error=True)
+    assert not root.is_sampled() and root.is_recorded()
+    assert child.flags & RECORD_FLAG
+    assert 'sampler.type' not in dict(root.tags)
+    assert len(inner.get_spans()) == 2
+
+    carrier = {}
+    tracer.inject(child.context, Format.TEXT_MAP, carrier)
+    remote = tracer.extract(Format.TEXT_MAP, carrier)
+    assert remote.flags == 0
+    # the service receiving the trace records it if it has record_all too
+    server = tracer.start_span('server', child_of=remote)
+    assert isinstance(server, Span)
+    assert server.is_recorded() and not server.is_sampled()
+    assert server.trace_id == child.trace_id
+
+
+def test_unsampled_traces_are_not_recorded_without_record_all():
+    tracer = Tracer(client=None, service_name='svc',
+                    reporter=InMemoryReporter(), sampler=ConstSampler(False))
+    remote = SpanContext(trace_id=1, span_id=2, parent_id=None, flags=0)
+    assert isinstance(tracer.start_span('server', child_of=remote),
+                      UnsampledSpan)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork()')
+def test_forked_child_starts_with_an_empty_buffer():
+    tracer, inner = make_tracer(ConstSampler(False))
+    root = tracer.start_span('root')
+    tracer.start_span('child', child_of=root).finish()
+    # as if another thread was reporting a span when the process forked
+    with tracer.reporter.lock:
+        pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            assert not tracer.reporter._traces
+            finish_trace(tracer, error=True)
+            if len(inner.get_spans()) == 2:
+                status = 0
+        finally:
+            os._exit(status)
+    _, status = os.waitpid(pid, 0)
+    assert status == 0
+    assert len(tracer.reporter._traces) == 1
+
+
+def test_policies_decide_on_unsampled_traces():
+    tracer, inner = make_tracer(ConstSampler(False))
+    kept, _ = finish_trace(tracer, error=True)
+    finish_trace(tracer)
+    assert set(span.trace_id for span in inner.get_spans()) == \
+        set([kept.trace_id])
+
+
+def test_sampled_traces_are_kept():
+    tracer, inner = make_tracer(ConstSampler(True))
+    root, _ = finish_trace(tracer)
+    assert root.is_sampled()
+    assert dict(root.tags)['sampler.type'] == 'const'
+    assert len(inner.get_spans()) == 2
+
+
+def test_config_keeps_the_configured_sampler():
+    config = Config({
+        'sampler': {'type': 'probabilistic', 'param': 0.001},
+        'tail_sampling': {'latency_threshold': 0.5},
+    }, service_name='svc')
+    tracer = config.initialize_tracer()
+    try:
+        assert isinstance(tracer.sampler, ProbabilisticSampler)
+        assert tracer.record_all
+        assert isinstance(tracer.reporter, TailSamplingReporter)
+    finally:
+        tracer.close().result(5)
+        Config._initialized = False
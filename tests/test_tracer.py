@@ -0,0 +1,80 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+from opentracing import Format
+from opentracing.ext import tags as ext_tags
+
+from tracing import ConstSampler, Tracer
+from tracing.span import Span, UnsampledSpan
+
+
+@pytest.fixture
+def unsampled_tracer(reporter):
+    return Tracer(client=None, service_name='test-service', reporter=reporter,
+                  sampler=ConstSampler(False))
+
+
+def test_children_of_unsampled_spans_share_the_context(unsampled_tracer,
+                                                       reporter):
+    root = unsampled_tracer.start_span('root')
+    child = unsampled_tracer.start_span('child', child_of=root)
+    assert isinstance(child, UnsampledSpan)
+    assert child.context is root.context
+    with unsampled_tracer.start_active_span('scoped', child_of=root) as scope:
+        assert isinstance(scope.span, UnsampledSpan)
+        assert isinstance(unsampled_tracer.start_span('nested'),
+                          UnsampledSpan)
+    child.set_tag('user.id', 1)
+    child.log_kv({'event': 'ignored'})
+    child.finish()
+    root.finish()
+    assert reporter.get_spans() == []
+
+
+def test_unsampled_spans_are_propagated(unsampled_tracer):
+    root = unsampled_tracer.start_span('root')
+    child = unsampled_tracer.start_span('child', child_of=root)
+    carrier = {}
+    unsampled_tracer.inject(child.context, Format.TEXT_MAP, carrier)
+    remote = unsampled_tracer.extract(Format.TEXT_MAP, carrier)
+    assert remote.trace_id == root.trace_id
+    assert remote.span_id == root.span_id
+    assert not remote.flags
+
+
+def test_baggage_of_unsampled_spans_stays_with_the_child(unsampled_tracer):
+    root = unsampled_tracer.start_span('root')
+    root.set_baggage_item('tenant', 'a')
+    child = unsampled_tracer.start_span('child', child_of=root)
+    child.set_baggage_item('tenant', 'b')
+    child.set_baggage_item('user', 'c')
+    assert child.get_baggage_item('tenant') == 'b'
+    assert child.get_baggage_item('user') == 'c'
+    assert root.context.baggage == {'tenant': 'a'}
+    assert child.context is not root.context
+    assert child.trace_id == root.trace_id
+
+
+def test_sampling_priority_starts_a_real_span(unsampled_tracer, reporter):
+    root = unsampled_tracer.start_span('root')
+    child = unsampled_tracer.start_span(
+        'child', child_of=root, tags={ext_tags.SAMPLING_PRIORITY: 1})
+    assert not isinstance(child, UnsampledSpan)
+    assert isinstance(child, Span)
+    assert child.is_sampled() and child.is_debug()
+    assert child.trace_id == root.trace_id
+    assert child.parent_id == root.span_id
+    child.finish()
+    assert reporter.get_spans() == [child]
@@ -20,7 +20,8 @@ __version__ = '0.0.2.dev0'
 
 from .tracer import Tracer  # noqa
 from .config import Config  # noqa
-from .span import Span  # noqa
+from .span import Span, SpanPool  # noqa
+from .scope_manager import Scope, ThreadLocalScopeManager  # noqa
 from .span_context import SpanContext  # noqa
 from .sampler import ConstSampler  # noqa
 # from .sampler import ProbabilisticSampler  # noqa
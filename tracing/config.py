@@ -15,6 +15,7 @@
 from __future__ import absolute_import
 
 from builtins import object
+import functools
 import logging
 import os
 import threading
@@ -23,11 +24,21 @@ import opentracing
 from opentracing.propagation import Format
 import stagedb
 from . import Tracer
-# from .local_agent_net import LocalAgentSender
 from .reporter import (
     Reporter,
     LoggingReporter,
+    OVERFLOW_DROP_NEWEST,
 )
+from .scope_manager import ThreadLocalScopeManager
+from .span import SpanPool
+from .spill import SpillBuffer
+from .tail_sampling import (
+    TailSamplingReporter,
+    LatencyPolicy,
+    ErrorPolicy,
+    OperationPolicy,
+)
+from .id_generator import RandomIdGenerator, TimeOrderedIdGenerator
 from .sampler import (
     ConstSampler,
     ProbabilisticSampler,
@@ -36,9 +47,22 @@ from .sampler import (
 from .constants import (
     DEFAULT_SAMPLING_INTERVAL,
     DEFAULT_FLUSH_INTERVAL,
+    DEFAULT_MAX_PACKET_SIZE,
+    DEFAULT_CLOSE_TIMEOUT,
+    DEFAULT_COMPRESSION_THRESHOLD,
+    DEFAULT_SPILL_REPLAY_RATE,
+    DEFAULT_SPILL_SIZE,
+    DEFAULT_TAIL_SAMPLING_MAX_BYTES,
+    DEFAULT_TAIL_SAMPLING_SPAN_OVERHEAD,
+    DEFAULT_TAIL_SAMPLING_TRACE_TIMEOUT,
+    DEFAULT_TRACE_CACHE_SIZE,
     SAMPLER_TYPE_CONST,
     SAMPLER_TYPE_PROBABILISTIC,
     SAMPLER_TYPE_RATE_LIMITING,
+    ID_GENERATOR_RANDOM,
+    ID_GENERATOR_TIME_ORDERED,
+    SCOPE_MANAGER_THREAD_LOCAL,
+    SCOPE_MANAGER_CONTEXTVARS,
     TRACE_ID_HEADER,
     BAGGAGE_HEADER_PREFIX,
     DEBUG_ID_HEADER_KEY,
@@ -54,6 +78,9 @@ DEFAULT_REPORTING_PORT = 1206
 DEFAULT_SAMPLING_PORT = 5778
 LOCAL_AGENT_DEFAULT_ENABLED = True
 
+REPORTER_PROTOCOL_STAGEDB = 'stagedb'
+REPORTER_PROTOCOL_UDP = 'udp'
+
 DEFAULT_DATABASE_HOST = 'localhost'
 DEFAULT_DATABASE_PORT = 1206
 
@@ -111,6 +138,102 @@ class Config(object):
     def reporter_queue_size(self):
         return int(self.config.get('reporter_queue_size', 100))
 
+    @property
+    def reporter_max_inflight(self):
+        return int(self.config.get('reporter_max_inflight', 0))
+
+    @property
+    def reporter_inflight_timeout(self):
+        return float(self.config.get('reporter_inflight_timeout',
+                                     DEFAULT_FLUSH_INTERVAL))
+
+    @property
+    def reporter_protocol(self):
+        """
+        :return: Returns how the reporter submits spans: 'stagedb' writes
+        them to the local agent's stagedb, 'udp' sends them as datagrams
+        to the local algo-agent
+        """
+        return self.config.get('reporter_protocol', REPORTER_PROTOCOL_STAGEDB)
+
+    @property
+    def reporter_max_packet_size(self):
+        return int(self.config.get('reporter_max_packet_size',
+                                   DEFAULT_MAX_PACKET_SIZE))
+
+    @property
+    def reporter_spill_path(self):
+        """
+        :return: Returns the path of the reporter's on-disk spill file, or
+        None if spans that cannot be queued or written are dropped. Forked
+        workers spill to <path>.<pid>, and the spans left there by a
+        worker that exited are adopted by the next one started
+        """
+        return self.config.get('reporter_spill_path', None)
+
+    @property
+    def reporter_spill_size(self):
+        return int(self.config.get('reporter_spill_size', DEFAULT_SPILL_SIZE))
+
+    @property
+    def reporter_spill_replay_rate(self):
+        return float(self.config.get('reporter_spill_replay_rate',
+                                     DEFAULT_SPILL_REPLAY_RATE))
+
+    @property
+    def reporter_overflow_policy(self):
+        """
+        :return: Returns what the reporter does with a span when its queue
+        is full: 'drop_newest', 'drop_oldest', 'block' or 'drop_non_debug'
+        """
+        return self.config.get('reporter_overflow_policy',
+                               OVERFLOW_DROP_NEWEST)
+
+    @property
+    def reporter_block_timeout(self):
+        return float(self.config.get('reporter_block_timeout',
+                                     DEFAULT_FLUSH_INTERVAL))
+
+    @property
+    def reporter_compression(self):
+        """
+        :return: Returns how the reporter compresses batches: None, 'zlib'
+        or 'zlib_dict'
+        """
+        return self.config.get('reporter_compression', None)
+
+    @property
+    def reporter_compression_threshold(self):
+        return int(self.config.get('reporter_compression_threshold',
+                                   DEFAULT_COMPRESSION_THRESHOLD))
+
+    @property
+    def reporter_trace_linger(self):
+        """
+        :return: Returns how long the reporter holds back spans to write
+        each trace as one stagedb value, in seconds, 0 if spans are written
+        in batches as they finish
+        """
+        return float(self.config.get('reporter_trace_linger', 0))
+
+    @property
+    def reporter_trace_cache_size(self):
+        return int(self.config.get('reporter_trace_cache_size',
+                                   DEFAULT_TRACE_CACHE_SIZE))
+
+    @property
+    def reporter_close_timeout(self):
+        return float(self.config.get('reporter_close_timeout',
+                                     DEFAULT_CLOSE_TIMEOUT))
+
+    @property
+    def span_pool_size(self):
+        """
+        :return: Returns how many reported spans are kept for reuse by
+        start_span(), 0 if spans are not pooled
+        """
+        return int(self.config.get('span_pool_size', 0))
+
     @property
     def logging(self):
         return get_boolean(self.config.get('logging', False), False)
@@ -166,6 +289,90 @@ class Config(object):
 
         raise ValueError('Unknown sampler type %s' % sampler_type)
 
+    @property
+    def tail_sampling_policies(self):
+        """
+        :return: Returns the TailSamplingPolicy list described by
+        config['tail_sampling'], or None if traces are not tail sampled
+        """
+        tail_config = self.config.get('tail_sampling', None)
+        if not tail_config:
+            return None
+        policies = []
+        if tail_config.get('latency_threshold') is not None:
+            policies.append(
+                LatencyPolicy(float(tail_config['latency_threshold'])))
+        if get_boolean(tail_config.get('errors', True), True):
+            policies.append(ErrorPolicy())
+        if tail_config.get('operations'):
+            policies.append(OperationPolicy(tail_config['operations']))
+        return policies
+
+    @property
+    def tail_sampling_max_bytes(self):
+        return int(self.config.get('tail_sampling', {}).get(
+            'max_bytes', DEFAULT_TAIL_SAMPLING_MAX_BYTES))
+
+    @property
+    def tail_sampling_span_overhead(self):
+        return int(self.config.get('tail_sampling', {}).get(
+            'span_overhead', DEFAULT_TAIL_SAMPLING_SPAN_OVERHEAD))
+
+    @property
+    def tail_sampling_trace_timeout(self):
+        return float(self.config.get('tail_sampling', {}).get(
+            'trace_timeout', DEFAULT_TAIL_SAMPLING_TRACE_TIMEOUT))
+
+    @property
+    def id_generator(self):
+        """
+        :return: Returns the span ID generator named by config['id_generator'],
+        'random' or 'time_ordered', or None for the tracer's default
+        """
+        generator_type = self.config.get('id_generator', None)
+        if not generator_type:
+            return None
+        elif generator_type == ID_GENERATOR_RANDOM:
+            return RandomIdGenerator()
+        elif generator_type == ID_GENERATOR_TIME_ORDERED:
+            return TimeOrderedIdGenerator()
+
+        raise ValueError('Unknown id generator %s' % generator_type)
+
+    @property
+    def scope_manager(self):
+        """
+        :return: Returns the ScopeManager named by config['scope_manager'],
+        'thread_local' or 'contextvars', or None for the tracer's default
+        """
+        manager_type = self.config.get('scope_manager', None)
+        if not manager_type:
+            return None
+        elif manager_type == SCOPE_MANAGER_THREAD_LOCAL:
+            return ThreadLocalScopeManager()
+        elif manager_type == SCOPE_MANAGER_CONTEXTVARS:
+            # needs Python 3.7+
+            from .contextvars_scope_manager import ContextVarsScopeManager
+            return ContextVarsScopeManager()
+
+        raise ValueError('Unknown scope manager %s' % manager_type)
+
+    @property
+    def generate_128bit_trace_id(self):
+        """
+        :return: Returns True if trace IDs should be 128 bits wide
+        """
+        return get_boolean(self.config.get('generate_128bit_trace_id', False),
+                           False)
+
+    @property
+    def log_error_stack(self):
+        """
+        :return: Returns True if spans should log the traceback of an
+        exception raised in a scope's block
+        """
+        return get_boolean(self.config.get('log_error_stack', False), False)
+
     @property
     def sampling_refresh_interval(self):
         return self.config.get('sampling_refresh_interval',
@@ -263,7 +470,7 @@ class Config(object):
                 return
             Config._initialized = True
 
-        channel = self._create_local_agent_channel()
+        channel = self._create_local_agent_channel(io_loop=io_loop)
         db_client = self._create_remote_agent_stagedb()
         sampler = self.sampler
         # if sampler is None:
@@ -279,28 +486,69 @@ class Config(object):
 
         reporter = Reporter(
             channel=channel,
+            channel_factory=functools.partial(
+                self._create_local_agent_channel, io_loop=io_loop),
             queue_capacity=self.reporter_queue_size,
             batch_size=self.reporter_batch_size,
             flush_interval=self.reporter_flush_interval,
+            max_inflight=self.reporter_max_inflight,
+            inflight_timeout=self.reporter_inflight_timeout,
+            spill=self._create_spill_buffer(),
+            spill_replay_rate=self.reporter_spill_replay_rate,
+            overflow_policy=self.reporter_overflow_policy,
+            block_timeout=self.reporter_block_timeout,
+            compression=self.reporter_compression,
+            compression_threshold=self.reporter_compression_threshold,
+            trace_linger=self.reporter_trace_linger,
+            trace_cache_size=self.reporter_trace_cache_size,
+            close_timeout=self.reporter_close_timeout,
+            io_loop=io_loop,
             logger=logger,
             metrics_factory=self._metrics_factory,
             error_reporter=self.error_reporter)
 
+        policies = self.tail_sampling_policies
+        record_all = policies is not None
+        if record_all:
+            # the sampled traces are kept as a baseline of ordinary traces,
+            # the unsampled ones are only recorded for the policies
+            if sampler is None:
+                sampler = ConstSampler(decision=False)
+            reporter = TailSamplingReporter(
+                reporter, policies,
+                max_bytes=self.tail_sampling_max_bytes,
+                span_overhead=self.tail_sampling_span_overhead,
+                trace_timeout=self.tail_sampling_trace_timeout,
+                metrics_factory=self._metrics_factory)
+            logger.info('Tail sampling with %s',
+                        ', '.join(str(policy) for policy in policies))
+
         # if self.logging:
         #     reporter = CompositeReporter(reporter, LoggingReporter(logger))
 
         tracer = self.create_tracer(
             reporter=reporter,
             sampler=sampler,
-            client=db_client
+            client=db_client,
+            client_factory=self._create_remote_agent_stagedb,
+            record_all=record_all,
         )
 
         self._initialize_global_tracer(tracer=tracer)
         return tracer
 
-    def create_tracer(self, reporter, sampler,client):
+    def create_tracer(self, reporter, sampler, client, client_factory=None,
+                      record_all=False):
         return Tracer(
             client=client,
+            client_factory=client_factory,
+            id_generator=self.id_generator,
+            generate_128bit_trace_id=self.generate_128bit_trace_id,
+            span_pool=SpanPool(self.span_pool_size)
+            if self.span_pool_size > 0 else None,
+            scope_manager=self.scope_manager,
+            log_error_stack=self.log_error_stack,
+            record_all=record_all,
             service_name=self.service_name,
             reporter=reporter,
             sampler=sampler,
@@ -321,20 +569,30 @@ class Config(object):
     def _create_local_agent_channel(self, io_loop=None):
         """
         Create an out-of-process channel communicating to local algo-agent.
-        Spans are submitted as SOCK_DGRAM Thrift, sampling strategy is polled
-        via JSON HTTP.
+        With the 'udp' reporter protocol spans are submitted as SOCK_DGRAM
+        batch envelopes, otherwise they are written to the agent's stagedb.
 
         :param self: instance of Config
         """
-        # logger.info('Initializing Algo Tracer with UDP reporter')
-        # return LocalAgentSender(
-        #     host=self.local_agent_reporting_host,
-        #     sampling_port=self.local_agent_sampling_port,
-        #     reporting_port=self.local_agent_reporting_port,
-        #     io_loop=io_loop
-        # )
+        if self.reporter_protocol == REPORTER_PROTOCOL_UDP:
+            # needs thrift, which the stagedb protocol does without
+            from .local_agent_net import LocalAgentSender
+            logger.info('Initializing Algo Tracer with UDP reporter')
+            return LocalAgentSender(
+                host=self.local_agent_reporting_host,
+                reporting_port=self.local_agent_reporting_port,
+                max_packet_size=self.reporter_max_packet_size,
+                io_loop=io_loop
+            )
         return stagedb.client(self.local_agent_reporting_host, self.local_agent_reporting_port, 10)
 
+    def _create_spill_buffer(self):
+        if not self.reporter_spill_path:
+            return None
+        logger.info('Spilling unreported spans to %s', self.reporter_spill_path)
+        return SpillBuffer(path=self.reporter_spill_path,
+                           size=self.reporter_spill_size)
+
     def _create_remote_agent_stagedb(self):
 
         logger.info('Initializing Algo Tracer with stagedb reporter')
@@ -21,12 +21,53 @@ import six
 # Max number of bits to use when generating random ID
 MAX_ID_BITS = 64
 
+# Number of bits in a trace ID when 128-bit trace IDs are enabled
+MAX_TRACE_ID_BITS = 128
+
+# Largest datagram the UDP reporter packs spans into. Stays below the 65507
+# bytes UDP payload limit of IPv4.
+DEFAULT_MAX_PACKET_SIZE = 65000
+
 # How often remotely controller sampler polls for sampling strategy
 DEFAULT_SAMPLING_INTERVAL = 60
 
 # How often remote reporter does a preemptive flush of its buffers
 DEFAULT_FLUSH_INTERVAL = 1
 
+# How long closing the reporter waits for buffered spans to be flushed
+DEFAULT_CLOSE_TIMEOUT = 5
+
+# How many spilled batches the reporter replays to stagedb per second
+DEFAULT_SPILL_REPLAY_RATE = 10
+
+# Capacity of the reporter's on-disk spill file, in bytes
+DEFAULT_SPILL_SIZE = 64 * 1024 * 1024
+
+# Max number of reported spans a SpanPool keeps for reuse
+DEFAULT_SPAN_POOL_SIZE = 1024
+
+# How many written traces the reporter remembers, to merge their late spans
+DEFAULT_TRACE_CACHE_SIZE = 1024
+
+# Memory ceiling of the tail sampling buffer, in bytes
+DEFAULT_TAIL_SAMPLING_MAX_BYTES = 64 * 1024 * 1024
+
+# Memory charged for a span in the tail sampling buffer, in bytes
+DEFAULT_TAIL_SAMPLING_SPAN_OVERHEAD = 2048
+
+# How long the tail sampling buffer keeps a trace without new spans
+DEFAULT_TAIL_SAMPLING_TRACE_TIMEOUT = 30
+
+# How many spans InMemoryReporter keeps before evicting the oldest
+DEFAULT_IN_MEMORY_CAPACITY = 100000
+
+# Width of the start time buckets InMemoryReporter indexes spans by, in
+# seconds
+DEFAULT_IN_MEMORY_TIME_BUCKET = 1
+
+# Batches smaller than this many bytes are not worth compressing
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
 # Name of the HTTP header used to encode trace ID
 TRACE_ID_HEADER = 'algo-trace-id' if six.PY3 else b'algo-trace-id'
 
@@ -47,6 +88,9 @@ ALGO_VERSION_TAG_KEY = 'algo.version'
 # Tracer-scoped tag that contains the hostname
 ALGO_HOSTNAME_TAG_KEY = 'algo.hostname'
 
+# Tracer-scoped tag that contains the numeric code of the service
+ALGO_SERVICE_CODE_TAG_KEY = 'algo.service-code'
+
 # the type of sampler that always makes the same decision.
 SAMPLER_TYPE_CONST = 'const'
 
@@ -66,6 +110,18 @@ SAMPLER_TYPE_RATE_LIMITING = 'ratelimiting'
 # noinspection SpellCheckingInspection
 SAMPLER_TYPE_LOWER_BOUND = 'lowerbound'
 
+# span IDs are random 64-bit numbers
+ID_GENERATOR_RANDOM = 'random'
+
+# span IDs start with a millisecond timestamp and sort by creation time
+ID_GENERATOR_TIME_ORDERED = 'time_ordered'
+
+# the active span is kept per thread
+SCOPE_MANAGER_THREAD_LOCAL = 'thread_local'
+
+# the active span is kept in a context variable, per asyncio task
+SCOPE_MANAGER_CONTEXTVARS = 'contextvars'
+
 # max length for tag values. Longer values will be truncated.
 MAX_TAG_VALUE_LENGTH = 1024
 
@@ -75,6 +131,11 @@ SAMPLED_FLAG = 0x01
 # Constant for debug flag
 DEBUG_FLAG = 0x02
 
+# Constant for the record flag: the span is recorded without being sampled,
+# for a TailSamplingReporter to decide on. Never propagated, see
+# Tracer.inject()
+RECORD_FLAG = 0x100
+
 
 DATABASE_HOST_KEY = 'db.host'
 
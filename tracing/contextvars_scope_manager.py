@@ -0,0 +1,66 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Active span propagation for asyncio, requires Python 3.7+.
+"""
+
+from __future__ import absolute_import
+
+import contextvars
+import functools
+
+from .scope_manager import Scope, ScopeManager
+
+
+class ContextVarsScopeManager(ScopeManager):
+    """
+    Keeps the stack of active scopes in a context variable. asyncio runs
+    every task in a copy of the context it was created in, by
+    create_task(), ensure_future() or gather(), so a task starts with the
+    span that was active where it was created, and the spans it activates
+    are never seen by other tasks. Threads have a context of their own.
+    """
+
+    def __init__(self):
+        self._scope = contextvars.ContextVar('algo_tracing_scope',
+                                             default=None)
+
+    def activate(self, span, finish_on_close):
+        scope = Scope(self, span, finish_on_close, self._scope.get())
+        self._scope.set(scope)
+        return scope
+
+    @property
+    def active(self):
+        return self._scope.get()
+
+    def _deactivate(self, scope):
+        # a scope closed out of order, or in another task, is left alone
+        if self._scope.get() is scope:
+            self._scope.set(scope._previous)
+
+
+def trace_coroutine(tracer, func, operation_name, tags):
+    """
+    Wrap a coroutine function so each call runs in an active span, used
+    by Tracer.trace() for coroutine functions.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        # start_span() may add to the tags it is given
+        with tracer.start_active_span(
+                operation_name, tags=dict(tags) if tags else None):
+            return await func(*args, **kwargs)
+    return wrapper
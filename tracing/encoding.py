@@ -0,0 +1,474 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compact binary encoding of finished spans, as stored by the Reporter.
+
+A span record is laid out as
+
+    u8      format version
+    varint  trace_id, span_id, parent_id (0 if none), flags
+    varint  start time and duration, in microseconds
+    string  operation name
+    varint  reference count, then per reference a u8 SpanRefType,
+            the varint trace_id and span_id it points to
+    varint  byte length of the tag/log section, followed by
+            varint tag count, tags, varint log count, logs
+
+Strings are a varint byte length followed by UTF-8 bytes. A tag is its
+key string, a u8 TagType and the value: a string, a u8 0 or 1 for BOOL,
+a zigzag varint for LONG, a big-endian IEEE 754 double for DOUBLE, or a
+varint byte length and the bytes for BINARY. A log is a varint timestamp in
+microseconds followed by a varint field count and the fields as tags.
+
+Spans are written in batch envelopes, which carry the process descriptor
+once for all the spans they hold:
+
+    u8      format version
+    string  service name
+    varint  process tag count, tags
+    varint  span count, then each span record prefixed by its byte length
+
+A batch envelope may be compressed by compress_batch(). The compressed
+form is a marker byte, BATCH_ZLIB or BATCH_ZLIB_DICT, followed by the zlib
+stream, and decode_batch() inflates it transparently.
+"""
+
+from __future__ import absolute_import
+
+from builtins import object
+import struct
+import zlib
+import six
+
+from . import thrift
+from .thrift import TagType
+
+SPAN_RECORD_VERSION = 2
+
+# records without references, still decoded
+SPAN_RECORD_VERSION_1 = 1
+
+BATCH_VERSION = 1
+
+_DOUBLE = struct.Struct('!d')
+
+_MIN_LONG = 1 << 63
+
+# TagType of the common value types, saves thrift.tag_type() on the hot path
+_EXACT_TAG_TYPES = dict(
+    [(six.text_type, TagType.STRING), (str, TagType.STRING)] +
+    [(t, TagType.LONG) for t in six.integer_types] +
+    [(bool, TagType.BOOL), (float, TagType.DOUBLE)])
+
+# Marker bytes of compressed batch envelopes
+BATCH_ZLIB = 0x81
+BATCH_ZLIB_DICT = 0x82
+
+# Preset dictionary for BATCH_ZLIB_DICT, made of the strings nearly every
+# batch repeats. zlib favours matches near the end of the dictionary, so
+# the most common strings come last. Changing it breaks the decoding of
+# stored batches, add a new marker instead.
+BATCH_ZDICT = b''.join([
+    b'http.method', b'http.status_code', b'http.url', b'component',
+    b'peer.port', b'peer.ipv4', b'peer.hostname', b'peer.service',
+    b'probabilistic', b'ratelimiting', b'lowerbound', b'const',
+    b'error', b'true', b'false', b'True', b'False',
+    b'algo.hostname', b'algo.version', b'Python-',
+    b'sampler.param', b'sampler.type', b'span.kind', b'client', b'server',
+])
+
+
+def _zdict_supported():
+    try:
+        zlib.compressobj(zdict=BATCH_ZDICT)
+    except TypeError:
+        return False
+    return True
+
+
+# preset dictionaries need Python 3.3+
+ZDICT_SUPPORTED = _zdict_supported()
+
+
+class SpanRecord(object):
+    """A span decoded from its stored record."""
+
+    __slots__ = ['trace_id', 'span_id', 'parent_id', 'flags',
+                 'operation_name', 'start_time', 'end_time', 'references',
+                 'tags', 'logs']
+
+    def __init__(self, trace_id, span_id, parent_id, flags, operation_name,
+                 start_time, end_time, references=None, tags=None, logs=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_id = parent_id or None
+        self.flags = flags
+        self.operation_name = operation_name
+        self.start_time = start_time
+        self.end_time = end_time
+        self.references = references or []
+        self.tags = tags
+        self.logs = logs
+
+    def __repr__(self):
+        return 'SpanRecord(%x:%x:%x:%x %s)' % (
+            self.trace_id, self.span_id, self.parent_id or 0, self.flags,
+            self.operation_name)
+
+
+def encode_process(process):
+    """
+    Encode a thrift.Process into the descriptor carried by batch envelopes.
+
+    :return: Returns the descriptor as bytes.
+    """
+    buf = bytearray()
+    _write_str(buf, process.serviceName)
+    _write_varint(buf, len(process.tags))
+    for tag in process.tags:
+        _write_tag(buf, tag)
+    return bytes(buf)
+
+
+def encode_batch(process_record, span_records):
+    """
+    Wrap encoded spans into a batch envelope.
+
+    :param process_record: the process descriptor from encode_process()
+    :param span_records: a list of span records from encode_span()
+    :return: Returns the envelope as bytes.
+    """
+    buf = bytearray()
+    buf.append(BATCH_VERSION)
+    buf.extend(process_record)
+    _write_varint(buf, len(span_records))
+    for record in span_records:
+        _write_varint(buf, len(record))
+        buf.extend(record)
+    return bytes(buf)
+
+
+def compress_batch(envelope, use_dict=False, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Compress a batch envelope with zlib.
+
+    :param envelope: the envelope from encode_batch()
+    :param use_dict: prime zlib with BATCH_ZDICT, requires ZDICT_SUPPORTED
+    :param level: zlib compression level
+    :return: Returns the compressed envelope as bytes.
+    """
+    if use_dict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS,
+                                      zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, BATCH_ZDICT)
+        marker = BATCH_ZLIB_DICT
+        data = compressor.compress(envelope) + compressor.flush()
+    else:
+        marker = BATCH_ZLIB
+        data = zlib.compress(envelope, level)
+    return bytes(bytearray([marker])) + data
+
+
+def decode_batch(data, with_tags=True):
+    """
+    Decode a batch envelope produced by encode_batch(), compressed or not.
+
+    :param data: the envelope, as bytes or bytearray
+    :param with_tags: passed on to decode_span()
+    :return: Returns a (thrift.Process, list of SpanRecord) tuple.
+    """
+    process, records = _split_batch(data)
+    return process, [decode_span(record, with_tags=with_tags)
+                     for record in records]
+
+
+def batch_records(data):
+    """
+    Take the span records out of a batch envelope, compressed or not,
+    without decoding them, e.g. to write them again with more spans.
+
+    :param data: the envelope, as bytes or bytearray
+    :return: Returns a list of span records as bytes.
+    """
+    return [bytes(record) for record in _split_batch(data)[1]]
+
+
+def _split_batch(data):
+    buf = bytearray(data)
+    if buf and buf[0] == BATCH_ZLIB:
+        buf = bytearray(zlib.decompress(bytes(buf[1:])))
+    elif buf and buf[0] == BATCH_ZLIB_DICT:
+        decompressor = zlib.decompressobj(zdict=BATCH_ZDICT)
+        buf = bytearray(decompressor.decompress(bytes(buf[1:])) +
+                        decompressor.flush())
+    if not buf or buf[0] != BATCH_VERSION:
+        raise ValueError('unsupported batch version')
+    service_name, pos = _read_str(buf, 1)
+    count, pos = _read_varint(buf, pos)
+    tags = []
+    for _ in range(count):
+        tag, pos = _read_tag(buf, pos)
+        tags.append(tag)
+    count, pos = _read_varint(buf, pos)
+    records = []
+    for _ in range(count):
+        length, pos = _read_varint(buf, pos)
+        records.append(buf[pos:pos + length])
+        pos += length
+    return thrift.Process(serviceName=service_name, tags=tags), records
+
+
+def encode_span(span):
+    """
+    Encode a finished span into a span record. Tag and log values are
+    converted to strings and truncated to the tracer's
+    max_tag_value_length here, off the request thread.
+
+    :param span: a finished Span
+    :return: Returns the record as bytes.
+    """
+    context = span.context
+    max_length = span.tracer.max_tag_value_length
+    start = thrift.timestamp_micros(span.start_time)
+    if span.duration_ns is not None:
+        duration = span.duration_ns // 1000
+    else:
+        end = thrift.timestamp_micros(span.end_time or span.start_time)
+        duration = max(end - start, 0)
+    buf = bytearray()
+    buf.append(SPAN_RECORD_VERSION)
+    _write_varint(buf, context.trace_id)
+    _write_varint(buf, context.span_id)
+    _write_varint(buf, context.parent_id or 0)
+    _write_varint(buf, context.flags)
+    _write_varint(buf, start)
+    _write_varint(buf, duration)
+    _write_str(buf, span.operation_name or '')
+    # a debug-id-only context has no IDs to point to
+    references = [ref for ref in span.references or ()
+                  if ref.referenced_context.trace_id]
+    _write_varint(buf, len(references))
+    for ref in references:
+        buf.append(thrift.make_ref_type(ref.type))
+        _write_varint(buf, ref.referenced_context.trace_id)
+        _write_varint(buf, ref.referenced_context.span_id or 0)
+
+    # snapshots, in case a tag is set after the span finished
+    tags = tuple(span.tags)
+    logs = tuple(span.logs)
+    section = bytearray()
+    _write_varint(section, len(tags))
+    for key, value in tags:
+        _write_raw_tag(section, key, value, max_length)
+    _write_varint(section, len(logs))
+    for timestamp, fields in logs:
+        _write_varint(section, thrift.timestamp_micros(timestamp))
+        _write_varint(section, len(fields))
+        for key, value in six.iteritems(fields):
+            _write_raw_tag(section, key, value, max_length)
+    _write_varint(buf, len(section))
+    buf.extend(section)
+    return bytes(buf)
+
+
+def decode_span(data, with_tags=True):
+    """
+    Decode a span record produced by encode_span().
+
+    :param data: the record, as bytes or bytearray
+    :param with_tags: if False, the tag/log section is skipped and the
+        returned record has tags and logs set to None
+    :return: Returns a SpanRecord.
+    """
+    buf = bytearray(data)
+    if not buf or buf[0] not in (SPAN_RECORD_VERSION, SPAN_RECORD_VERSION_1):
+        raise ValueError('unsupported span record version')
+    trace_id, pos = _read_varint(buf, 1)
+    span_id, pos = _read_varint(buf, pos)
+    parent_id, pos = _read_varint(buf, pos)
+    flags, pos = _read_varint(buf, pos)
+    start, pos = _read_varint(buf, pos)
+    duration, pos = _read_varint(buf, pos)
+    operation_name, pos = _read_str(buf, pos)
+    references = []
+    if buf[0] != SPAN_RECORD_VERSION_1:
+        count, pos = _read_varint(buf, pos)
+        for _ in range(count):
+            ref_type = buf[pos]
+            ref_trace_id, pos = _read_varint(buf, pos + 1)
+            ref_span_id, pos = _read_varint(buf, pos)
+            references.append(thrift.SpanRef(
+                refType=ref_type, traceId=ref_trace_id, spanId=ref_span_id))
+    tags, logs = None, None
+    if with_tags:
+        _, pos = _read_varint(buf, pos)
+        count, pos = _read_varint(buf, pos)
+        tags = []
+        for _ in range(count):
+            tag, pos = _read_tag(buf, pos)
+            tags.append(tag)
+        count, pos = _read_varint(buf, pos)
+        logs = []
+        for _ in range(count):
+            timestamp, pos = _read_varint(buf, pos)
+            field_count, pos = _read_varint(buf, pos)
+            fields = []
+            for _ in range(field_count):
+                tag, pos = _read_tag(buf, pos)
+                fields.append(tag)
+            logs.append(dict(timestamp=timestamp, fields=fields))
+    return SpanRecord(
+        trace_id=trace_id, span_id=span_id, parent_id=parent_id,
+        flags=flags, operation_name=operation_name,
+        start_time=start / 1000000.0,
+        end_time=(start + duration) / 1000000.0,
+        references=references, tags=tags, logs=logs)
+
+
+def _write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_str(buf, value):
+    if isinstance(value, six.text_type):
+        # unbound call skips the slow encode() override of future's newstr
+        value = six.text_type.encode(value, 'utf-8')
+    length = len(value)
+    if length < 0x80:
+        buf.append(length)
+    else:
+        _write_varint(buf, length)
+    buf.extend(value)
+
+
+def _read_str(buf, pos):
+    length, pos = _read_varint(buf, pos)
+    end = pos + length
+    return buf[pos:end].decode('utf-8'), end
+
+
+def _write_tag(buf, tag):
+    _write_str(buf, tag.key)
+    v_type = tag.vType
+    buf.append(v_type)
+    if v_type == TagType.STRING:
+        _write_str(buf, tag.vStr)
+    elif v_type == TagType.BOOL:
+        buf.append(1 if tag.vBool else 0)
+    elif v_type == TagType.LONG:
+        _write_varint(buf, _zigzag(tag.vLong))
+    elif v_type == TagType.DOUBLE:
+        buf.extend(_DOUBLE.pack(tag.vDouble))
+    else:
+        _write_varint(buf, len(tag.vBinary))
+        buf.extend(tag.vBinary)
+
+
+def _write_raw_tag(buf, key, value, max_length):
+    """Write a raw tag value without building a thrift.Tag first."""
+    if not isinstance(key, six.string_types):
+        key = _to_text(key)
+    _write_str(buf, key)
+    v_type = _EXACT_TAG_TYPES.get(type(value))
+    if v_type is None:
+        v_type = thrift.tag_type(value)
+    elif v_type == TagType.LONG and not -_MIN_LONG <= value < _MIN_LONG:
+        v_type = TagType.STRING
+    buf.append(v_type)
+    if v_type == TagType.STRING:
+        if not isinstance(value, six.text_type):
+            value = _to_text(value)
+        _write_str(buf, value[:max_length])
+    elif v_type == TagType.LONG:
+        _write_varint(buf, _zigzag(value))
+    elif v_type == TagType.BOOL:
+        buf.append(1 if value else 0)
+    elif v_type == TagType.DOUBLE:
+        buf.extend(_DOUBLE.pack(value))
+    else:
+        value = value[:max_length]
+        _write_varint(buf, len(value))
+        buf.extend(value)
+
+
+def _to_text(value):
+    """
+    :return: Returns a tag key or string tag value as text. On Python 2,
+        bytes that are not UTF-8, also those an object's __str__()
+        returns, are replaced. A value that cannot be converted is written
+        as its repr(), or as a placeholder, rather than failing the span.
+    """
+    if isinstance(value, bytes):
+        # a Python 2 str, Python 3 bytes are BINARY
+        return value.decode('utf-8', 'replace')
+    # noinspection PyBroadException
+    try:
+        return six.text_type(value)
+    except UnicodeDecodeError:
+        return str(value).decode('utf-8', 'replace')
+    except Exception:
+        pass
+    # noinspection PyBroadException
+    try:
+        return _to_text(repr(value))
+    except Exception:
+        return u'<unprintable %s>' % type(value).__name__
+
+
+def _read_tag(buf, pos):
+    key, pos = _read_str(buf, pos)
+    v_type = buf[pos]
+    pos += 1
+    if v_type == TagType.STRING:
+        value, pos = _read_str(buf, pos)
+        return thrift.Tag(key=key, vType=v_type, vStr=value), pos
+    if v_type == TagType.BOOL:
+        return thrift.Tag(key=key, vType=v_type, vBool=buf[pos] == 1), pos + 1
+    if v_type == TagType.LONG:
+        value, pos = _read_varint(buf, pos)
+        return thrift.Tag(key=key, vType=v_type, vLong=_unzigzag(value)), pos
+    if v_type == TagType.DOUBLE:
+        value = _DOUBLE.unpack_from(bytes(buf[pos:pos + _DOUBLE.size]))[0]
+        return thrift.Tag(key=key, vType=v_type, vDouble=value), \
+            pos + _DOUBLE.size
+    if v_type == TagType.BINARY:
+        length, pos = _read_varint(buf, pos)
+        end = pos + length
+        value = bytes(buf[pos:end])
+        return thrift.Tag(key=key, vType=v_type, vBinary=value), end
+    raise ValueError('unsupported tag type %d' % v_type)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
@@ -0,0 +1,113 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import object
+import os
+import random
+import socket
+import threading
+import time
+import zlib
+
+from .constants import MAX_ID_BITS
+
+
+class IdGenerator(object):
+    """
+    IdGenerator creates the span IDs of a Tracer. IDs must be non-zero,
+    fit in 64 bits and be unique across threads, since stored spans are
+    keyed by them.
+    """
+
+    def new_id(self):
+        raise NotImplementedError()
+
+    def reset(self):
+        """Re-seed the generator, called in a forked child process."""
+        pass
+
+
+class RandomIdGenerator(IdGenerator):
+    """
+    Generates random 64-bit IDs. getrandbits() runs under the GIL, so one
+    generator can be shared by all threads without a lock.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def new_id(self):
+        return self._getrandbits(MAX_ID_BITS) or 1
+
+    def reset(self):
+        # seeded from os.urandom()
+        self._getrandbits = random.Random().getrandbits
+
+    def __str__(self):
+        return 'RandomIdGenerator()'
+
+
+class TimeOrderedIdGenerator(IdGenerator):
+    """
+    Generates IDs that sort by creation time, laid out as
+
+        41 bits  milliseconds since EPOCH, until 2086
+        13 bits  node number, the process ID offset by a hash of the host
+        10 bits  sequence number
+
+    Pre-fork workers of one host have distinct PIDs, so they get distinct
+    node numbers unless their PIDs are 8192 or more apart. The sequence
+    number is not reset each millisecond but keeps counting from a random
+    start, and when a millisecond has issued all of its sequence numbers,
+    or the clock steps back, the generator moves on to the next one, so
+    IDs of one process never repeat.
+    """
+
+    EPOCH = 1483228800  # 2017-01-01T00:00:00Z
+    NODE_BITS = 13
+    SEQUENCE_BITS = 10
+
+    def __init__(self):
+        self.reset()
+
+    def new_id(self):
+        millis = int((time.time() - self.EPOCH) * 1000)
+        with self._lock:
+            if millis > self._millis:
+                self._millis = millis
+                self._issued = 1
+            elif self._issued > self._sequence_mask:
+                self._millis += 1
+                self._issued = 1
+            else:
+                self._issued += 1
+            self._sequence = sequence = \
+                (self._sequence + 1) & self._sequence_mask
+            return (self._millis << self._millis_shift) | self._node | sequence
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._sequence_mask = (1 << self.SEQUENCE_BITS) - 1
+        self._millis_shift = self.NODE_BITS + self.SEQUENCE_BITS
+        host = zlib.crc32(socket.gethostname().encode('utf-8'))
+        node = (host + os.getpid()) & ((1 << self.NODE_BITS) - 1)
+        self._node = node << self.SEQUENCE_BITS
+        self._millis = 0
+        self._issued = 0
+        self._sequence = random.SystemRandom().getrandbits(self.SEQUENCE_BITS)
+
+    def __str__(self):
+        return 'TimeOrderedIdGenerator()'
@@ -0,0 +1,32 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from .constants import DEFAULT_MAX_PACKET_SIZE
+from .TUDPTransport import TUDPTransport
+
+
+class LocalAgentSender(TUDPTransport):
+    """
+    LocalAgentSender submits span batches to the local algo-agent as
+    fire-and-forget UDP datagrams. The socket is non-blocking, so a full
+    send buffer raises socket.error (EAGAIN) instead of stalling the
+    reporter.
+    """
+    def __init__(self, host, reporting_port,
+                 max_packet_size=DEFAULT_MAX_PACKET_SIZE, io_loop=None):
+        super(LocalAgentSender, self).__init__(host=host, port=reporting_port)
+        self.max_packet_size = max_packet_size
+        self.io_loop = io_loop
@@ -13,7 +13,8 @@
 # limitations under the License.
 
 from builtins import object
-import time
+
+from .utils import monotonic
 
 
 class RateLimiter(object):
@@ -45,7 +46,7 @@ class RateLimiter(object):
 
     @staticmethod
     def timestamp():
-        return time.time()
+        return monotonic()
 
     def check_credit(self, item_cost):
         current_time = self.timestamp()
@@ -14,18 +14,64 @@
 
 from __future__ import absolute_import
 from builtins import object
+import functools
 import logging
-import threading
+import os
 import socket
-# from concurrent.futures import Future
-from .constants import DEFAULT_FLUSH_INTERVAL
-from . import thrift
+import struct
+import threading
+from collections import deque
+from collections import namedtuple
+from collections import OrderedDict
+from concurrent.futures import Future
+import six
+from .constants import (
+    DEFAULT_CLOSE_TIMEOUT,
+    DEFAULT_COMPRESSION_THRESHOLD,
+    DEFAULT_FLUSH_INTERVAL,
+    DEFAULT_IN_MEMORY_CAPACITY,
+    DEFAULT_IN_MEMORY_TIME_BUCKET,
+    DEFAULT_SPILL_REPLAY_RATE,
+    DEFAULT_TRACE_CACHE_SIZE,
+)
+from . import encoding, thrift
 from .metrics import Metrics, LegacyMetricsFactory
-from .utils import ErrorReporter
-import json
+from .rate_limiter import RateLimiter
+from .spill import SpillBuffer
+from .utils import ErrorReporter, AT_FORK_SUPPORTED, in_event_loop, \
+    monotonic, register_after_fork
 
 default_logger = logging.getLogger('algo_tracing')
 
+# Result of the future returned by close(): how many spans still buffered at
+# close time were written, sent or spilled, and how many were left behind,
+# because the deadline expired or they could not be written.
+FlushResult = namedtuple('FlushResult', ['flushed', 'abandoned'])
+
+# Bytes a batch envelope adds around the process descriptor (version and
+# span count), and the most a length prefix adds to a span record.
+_ENVELOPE_OVERHEAD = 6
+_RECORD_OVERHEAD = 3
+
+# What Reporter.report_span does when its queue is full
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_BLOCK = 'block'
+OVERFLOW_DROP_NON_DEBUG = 'drop_non_debug'
+OVERFLOW_POLICIES = (OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST,
+                     OVERFLOW_BLOCK, OVERFLOW_DROP_NON_DEBUG)
+
+# How Reporter compresses batches
+COMPRESSION_ZLIB = 'zlib'
+COMPRESSION_ZLIB_DICT = 'zlib_dict'
+
+# key length and span count in front of a spilled stagedb write
+_SPILL_ENTRY = struct.Struct('!HI')
+
+# Written traces whose spans fall out of the reporter's trace cache are
+# remembered by ID this many times longer, to merge late spans into them
+_TRACE_ID_HISTORY = 16
+
 
 class NullReporter(object):
     """Ignores all spans."""
@@ -35,27 +81,162 @@ class NullReporter(object):
     def set_process(self, service_name, tags, max_length):
         pass
 
-    def close(self):
-        # fut = Future()
-        # fut.set_result(True)
-        fut=None
+    def close(self, timeout=None):
+        fut = Future()
+        fut.set_result(FlushResult(flushed=0, abandoned=0))
         return fut
 
 
 class InMemoryReporter(NullReporter):
-    """Stores spans in memory and returns them via get_spans()."""
-    def __init__(self):
+    """
+    Stores the last capacity spans in memory, for tests and local
+    debugging, and indexes them by trace ID, operation name and start time.
+
+    Spans are numbered in the order they are reported. get_spans_since()
+    returns the spans after a cursor, so a poller copies every span once.
+    """
+    def __init__(self, capacity=DEFAULT_IN_MEMORY_CAPACITY,
+                 time_bucket=DEFAULT_IN_MEMORY_TIME_BUCKET):
+        """
+        :param capacity: how many spans are kept, the oldest span is
+            evicted to store a new one
+        :param time_bucket: width of the start time buckets spans are
+            indexed by, in seconds
+        """
         super(InMemoryReporter, self).__init__()
-        self.spans = []
+        if capacity <= 0:
+            raise ValueError('capacity must be positive, not %s' % capacity)
+        if time_bucket <= 0:
+            raise ValueError(
+                'time_bucket must be positive, not %s' % time_bucket)
+        self.capacity = capacity
+        self.time_bucket = time_bucket
         self.lock = threading.Lock()
+        self._next = 0
+        self.clear()
+
+    @property
+    def spans(self):
+        return self.get_spans()
+
+    @spans.setter
+    def spans(self, spans):
+        self.clear()
+        for span in spans:
+            self.report_span(span)
+
+    def clear(self):
+        """
+        Remove all stored spans. Cursors stay valid, spans reported later
+        are numbered on.
+        """
+        with self.lock:
+            # span number n is stored at n % capacity, with the keys it was
+            # indexed by when reported, as (span, trace ID, operation name,
+            # time bucket)
+            self._ring = [None] * self.capacity
+            self._first = self._next
+            # index key -> numbers of its stored spans, oldest first
+            self._by_trace = {}
+            self._by_operation = {}
+            self._by_time = {}
 
     def report_span(self, span):
         with self.lock:
-            self.spans.append(span)
+            number = self._next
+            slot = number % self.capacity
+            evicted = self._ring[slot]
+            if evicted is not None:
+                # the oldest span, first in each of its indexes; the span
+                # may have been renamed since, its stored keys are used
+                _, trace_id, operation_name, bucket = evicted
+                _unindex(self._by_trace, trace_id)
+                _unindex(self._by_operation, operation_name)
+                _unindex(self._by_time, bucket)
+            entry = (span, span.trace_id, span.operation_name,
+                     self._bucket(span.start_time))
+            self._ring[slot] = entry
+            self._next = number + 1
+            _index(self._by_trace, entry[1], number)
+            _index(self._by_operation, entry[2], number)
+            _index(self._by_time, entry[3], number)
 
     def get_spans(self):
+        """
+        :return: Returns a list of the stored spans, oldest first.
+        """
         with self.lock:
-            return self.spans[:]
+            return self._range(self._oldest(), self._next)
+
+    def get_spans_since(self, cursor=0):
+        """
+        Read the spans reported after a cursor. Spans evicted before they
+        were read are skipped.
+
+        :param cursor: the cursor returned by the previous call, or 0 for
+            all stored spans
+        :return: Returns a (list of spans, cursor) tuple.
+        """
+        with self.lock:
+            return self._range(max(cursor, self._oldest()), self._next), \
+                self._next
+
+    def get_trace(self, trace_id):
+        """
+        :return: Returns a list of the stored spans of a trace.
+        """
+        with self.lock:
+            return self._lookup(self._by_trace.get(trace_id, ()))
+
+    def get_spans_by_operation(self, operation_name):
+        """
+        :return: Returns a list of the stored spans of an operation.
+        """
+        with self.lock:
+            return self._lookup(
+                self._by_operation.get(operation_name, ()))
+
+    def get_spans_between(self, start_time, end_time):
+        """
+        :return: Returns a list of the stored spans started at or after
+            start_time and before end_time, as unix timestamps, in the
+            order they were reported.
+        """
+        first = self._bucket(start_time)
+        last = self._bucket(end_time)
+        with self.lock:
+            if last - first < len(self._by_time):
+                buckets = (self._by_time.get(bucket, ())
+                           for bucket in range(first, last + 1))
+            else:
+                buckets = (numbers for bucket, numbers in
+                           six.iteritems(self._by_time)
+                           if first <= bucket <= last)
+            numbers = sorted(n for bucket in buckets for n in bucket)
+            return [span for span in self._lookup(numbers)
+                    if start_time <= span.start_time < end_time]
+
+    def _oldest(self):
+        return max(self._first, self._next - self.capacity)
+
+    def _bucket(self, timestamp):
+        return int(timestamp // self.time_bucket)
+
+    def _range(self, start, end):
+        if start >= end:
+            return []
+        first = start % self.capacity
+        stop = first + end - start
+        if stop <= self.capacity:
+            entries = self._ring[first:stop]
+        else:
+            entries = self._ring[first:] + self._ring[:stop - self.capacity]
+        return [entry[0] for entry in entries]
+
+    def _lookup(self, numbers):
+        ring = self._ring
+        capacity = self.capacity
+        return [ring[number % capacity][0] for number in numbers]
 
 
 class LoggingReporter(NullReporter):
@@ -68,57 +249,992 @@ class LoggingReporter(NullReporter):
 
 
 class Reporter(NullReporter):
-    """Receives completed spans from Tracer and submits them out of process."""
-    def __init__(self, channel, error_reporter=None, metrics=None, metrics_factory=None, **kwargs):
-        from threading import Lock
+    """Receives completed spans from Tracer and submits them out of process.
+
+    Spans are buffered in a bounded in-memory queue and written to stagedb
+    by a background flusher thread, so finishing a span on the request
+    thread only costs an enqueue.
+
+    Given a Tornado IOLoop, the reporter runs no thread and flushes the
+    queue from a PeriodicCallback on the loop instead. Writes are then
+    always issued with async_put, and a full in-flight window leaves
+    spans queued for the next flush rather than waiting for it.
+
+    With a trace_linger, finished spans are held back per trace for that
+    long and every trace is written as one batch under
+    '/service|trace|<trace id>', so it is read back with a single get.
+    Spans finished after their trace was written are merged into it. If
+    the stored trace cannot be read back, they are written as a batch of
+    their own instead of replacing it. A trace is never rewritten while
+    an async_put of it is in flight, the newer version waits for it.
+    """
+    def __init__(self, channel, queue_capacity=100, batch_size=10,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, max_inflight=0,
+                 inflight_timeout=DEFAULT_FLUSH_INTERVAL, spill=None,
+                 spill_replay_rate=DEFAULT_SPILL_REPLAY_RATE,
+                 overflow_policy=OVERFLOW_DROP_NEWEST,
+                 block_timeout=DEFAULT_FLUSH_INTERVAL,
+                 compression=None,
+                 compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,
+                 trace_linger=0, trace_cache_size=DEFAULT_TRACE_CACHE_SIZE,
+                 close_timeout=DEFAULT_CLOSE_TIMEOUT, io_loop=None,
+                 error_reporter=None, metrics=None, metrics_factory=None,
+                 **kwargs):
+        """
+        :param channel: stagedb client the spans are written to, or a
+            LocalAgentSender to send them to the local algo-agent over UDP
+        :param queue_capacity: how many spans we can hold in memory before
+            starting to drop spans
+        :param batch_size: how many spans we write in one flush
+        :param flush_interval: how often the flusher writes a partially
+            filled batch, in seconds
+        :param max_inflight: when positive, spans are written with
+            async_put and at most this many writes are outstanding at once;
+            when 0, every span is written with a blocking put, or with an
+            unbounded number of async_puts on an io_loop
+        :param inflight_timeout: how long the flusher waits for a free
+            slot in a full in-flight window before spilling or dropping
+            the batch, and for a trace read back from stagedb, in seconds
+        :param spill: an optional SpillBuffer. Spans that do not fit into
+            the queue, or cannot be written because stagedb is failing or
+            too slow, are stored there instead of being dropped, and
+            replayed to stagedb once writes succeed again. A forked child
+            spills to a ring of its own at <spill path>.<pid>, which is
+            removed if it is empty when the child closes the reporter. The
+            spilled spans of a process that exited are adopted by the next
+            reporter started on the same spill path, see
+            SpillBuffer.adopt_orphans()
+        :param spill_replay_rate: how many spilled batches are replayed per
+            second at most
+        :param overflow_policy: what report_span does when the queue is
+            full: OVERFLOW_DROP_NEWEST drops the reported span,
+            OVERFLOW_DROP_OLDEST drops the oldest queued span,
+            OVERFLOW_BLOCK waits up to block_timeout seconds for room and
+            then drops the reported span, OVERFLOW_DROP_NON_DEBUG drops the
+            oldest queued non-debug span to make room for a debug span and
+            drops the reported span otherwise. Dropped spans go to the spill
+            buffer if there is one. OVERFLOW_BLOCK never blocks an asyncio
+            event loop, spans reported from one are dropped at once.
+        :param block_timeout: how long OVERFLOW_BLOCK waits, in seconds
+        :param compression: None, COMPRESSION_ZLIB, or COMPRESSION_ZLIB_DICT
+            to prime zlib with a dictionary of common span strings
+        :param compression_threshold: batches smaller than this many bytes
+            are written uncompressed
+        :param trace_linger: when positive, spans are kept for this many
+            seconds after the first span of their trace is flushed, and
+            written together with the other spans of the trace
+        :param trace_cache_size: how many lingering traces, and how many
+            written traces, are kept in memory at most. Late spans of a
+            written trace are merged with the cached spans, or with the
+            trace read back from stagedb once it left the cache
+        :param close_timeout: how long close() waits for buffered spans to
+            be flushed by default, in seconds
+        :param io_loop: a Tornado IOLoop to flush spans from, instead of a
+            flusher thread
+        :param error_reporter:
+        :param metrics: an instance of Metrics class, or None. This parameter
+            has been deprecated, please use metrics_factory instead.
+        :param metrics_factory: an instance of MetricsFactory class, or None.
+        :param kwargs:
+            'logger'
+            'channel_factory' - a callable that opens a new channel, used to
+            replace the inherited one in a forked child process
+        :return:
+        """
         self.metrics_factory = metrics_factory or LegacyMetricsFactory(metrics or Metrics())
         self.metrics = ReporterMetrics(self.metrics_factory)
-        self.error_reporter = error_reporter or ErrorReporter(Metrics())
+        self.error_reporter = error_reporter or ErrorReporter()
         self.logger = kwargs.get('logger', default_logger)
-        self.agent = None #Agent.Client(self._channel, self)
+        self.channel_factory = kwargs.get('channel_factory')
+        self.queue_capacity = queue_capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_inflight = max_inflight
+        self.inflight_timeout = inflight_timeout
+        self.agent = _local_agent(channel)
         self.stopped = False
-        self.stop_lock = Lock()
-        self._process_lock = Lock()
         self._process = None
+        self._process_record = None
         self._algodb = channel
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy %s' % overflow_policy)
+        if compression == COMPRESSION_ZLIB_DICT and \
+                not encoding.ZDICT_SUPPORTED:
+            self.logger.warning(
+                'zlib preset dictionaries are not supported, using zlib')
+            compression = COMPRESSION_ZLIB
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.trace_linger = trace_linger
+        self.trace_cache_size = trace_cache_size
+        self.close_timeout = close_timeout
+        self.io_loop = io_loop
+        self.overflow_policy = overflow_policy
+        self.block_timeout = block_timeout
+        self.spill = None if self.agent is not None else spill
+        # the configured path, forked children spill next to it
+        self._spill_path = spill.path if self.spill is not None else None
+        self._backend_healthy = True
+        self._replay_limiter = RateLimiter(
+            credits_per_second=spill_replay_rate,
+            max_balance=max(spill_replay_rate, 1.0))
+        self._delivered = 0
+        self._lost = 0
+        self._close_future = None
+        self._start_worker()
+        register_after_fork(self)
+
+    def _start_worker(self):
+        """
+        Create the queue, the locks and the flusher thread, or schedule the
+        flushes on the io_loop. Also called in a forked child, which
+        inherits neither the parent's thread nor a usable state of its
+        locks.
+        """
+        self._pid = os.getpid()
+        self.stop_lock = threading.Lock()
+        self._process_lock = threading.Lock()
+        self._queue = deque()
+        # spans dropped from the full queue, waiting to be spilled
+        self._overflow = deque()
+        queue_lock = threading.Lock()
+        self._queue_cond = threading.Condition(queue_lock)
+        self._queue_not_full = threading.Condition(queue_lock)
+        self._packet = []
+        self._packet_size = 0
+        self._flushing = 0
+        self._inflight = 0
+        self._inflight_spans = 0
+        self._inflight_cond = threading.Condition(threading.Lock())
+        self._delivered_lock = threading.Lock()
+        # trace_linger state, only used by the flusher: lingering traces in
+        # the order they expire, the spans of recently written traces, IDs
+        # of older written traces, traces waiting for a read-back and
+        # traces read back on the io_loop, waiting to be written
+        self._traces = OrderedDict()
+        self._lingering_spans = 0
+        self._written = OrderedDict()
+        self._evicted = OrderedDict()
+        self._merging = {}
+        self._merged = deque()
+        # keys of traces with an async_put in flight, and the newer
+        # version of the trace waiting for it, if any
+        self._trace_writes = {}
+        if self.io_loop is not None:
+            self._flusher = None
+            self._periodic = None
+            self._flush_scheduled = False
+            self._replaying = False
+            self._drained = threading.Event()
+            # add_callback() is the only IOLoop method safe to call from
+            # another thread
+            self.io_loop.add_callback(self._start_periodic)
+            return
+        self._flusher = threading.Thread(target=self._consume_queue,
+                                         name='algo-reporter-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _after_fork(self):
+        """
+        Restart the reporter in a forked child. Spans queued in the parent
+        are discarded, the parent reports them itself. The channel and the
+        spill file are not shared with the parent.
+        """
+        if self._pid == os.getpid():
+            return
+        # a close() of the parent is not waited for in the child
+        self._close_future = None
+        if self.channel_factory is not None:
+            self._algodb = self.channel_factory()
+            self.agent = _local_agent(self._algodb)
+        if self.spill is not None:
+            self.spill = SpillBuffer(
+                path='%s.%d' % (self._spill_path, os.getpid()),
+                size=self.spill.size)
+        self._backend_healthy = True
+        if self.stopped:
+            self._pid = os.getpid()
+        else:
+            self._start_worker()
 
     def set_process(self, service_name, tags, max_length):
         with self._process_lock:
-            # self._process = thrift.make_process(
-            #     service_name=service_name, tags=tags, max_length=max_length,
-            # )
-            self._process = (service_name, thrift.make_tags(tags=tags, max_length=max_length,))
-
+            self._process = thrift.make_process(
+                service_name=service_name, tags=tags, max_length=max_length,
+            )
+            self._process_record = encoding.encode_process(self._process)
 
     def report_span(self, span):
-        self._submit(span)
+        if not AT_FORK_SUPPORTED and self._pid != os.getpid():
+            self._after_fork()
+        with self._queue_cond:
+            if self.stopped:
+                dropped = span
+            elif len(self._queue) < self.queue_capacity:
+                dropped = None
+            else:
+                dropped = self._make_room(span)
+            if dropped is not span:
+                self._queue.append(span)
+                if len(self._queue) >= self.batch_size:
+                    if self.io_loop is None:
+                        self._queue_cond.notify()
+                    elif not self._flush_scheduled:
+                        self._flush_scheduled = True
+                        self.io_loop.add_callback(self._flush_on_loop)
+            if dropped is not None and self.spill is not None and \
+                    not self.stopped and \
+                    len(self._overflow) < self.queue_capacity:
+                # spilled by the flusher, off the caller's thread
+                self._overflow.append(dropped)
+                dropped = None
+        if dropped is not None:
+            self.metrics.reporter_dropped(1)
+
+    def _make_room(self, span):
+        """
+        Apply the overflow policy to a full queue. Must be called while
+        holding the queue lock.
+
+        :return: Returns the span to drop, which is either the reported
+            span or one removed from the queue, or None if the queue has
+            room for the reported span.
+        """
+        policy = self.overflow_policy
+        if policy == OVERFLOW_DROP_OLDEST:
+            return self._queue.popleft()
+        if policy == OVERFLOW_BLOCK and self.io_loop is None and \
+                not in_event_loop():
+            deadline = monotonic() + self.block_timeout
+            while len(self._queue) >= self.queue_capacity:
+                remaining = deadline - monotonic()
+                if remaining <= 0 or self.stopped:
+                    return span
+                self._queue_not_full.wait(remaining)
+            return None
+        if policy == OVERFLOW_DROP_NON_DEBUG and span.is_debug():
+            for i, queued in enumerate(self._queue):
+                if not queued.is_debug():
+                    del self._queue[i]
+                    return queued
+        return span
+
+    def _consume_queue(self):
+        if self.spill is not None:
+            self._adopt_orphans()
+        while True:
+            spans = self._next_batch()
+            if spans is None:
+                break
+            # noinspection PyBroadException
+            try:
+                self._submit(spans)
+                if self._overflow:
+                    self._spill_overflow()
+                if self.spill is not None:
+                    self._replay_spill()
+            except Exception:
+                self.logger.exception('Failed to flush spans')
+            self._recycle(spans)
+            with self._queue_cond:
+                self._flushing = 0
+        if self._overflow:
+            self._spill_overflow()
+        if self._traces:
+            self._flush_lingering()
+        if self._packet:
+            self._send_datagram(self._process_record)
+
+    def _next_batch(self):
+        """
+        Wait until a full batch is queued or the flush interval elapses.
+
+        :return: Returns a list of up to batch_size spans, possibly empty,
+            or None once the reporter is stopped and the queue is drained.
+        """
+        deadline = monotonic() + self.flush_interval
+        with self._queue_cond:
+            while len(self._queue) < self.batch_size and not self.stopped:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                self._queue_cond.wait(remaining)
+            if self.stopped and not self._queue:
+                return None
+            count = min(self.batch_size, len(self._queue))
+            spans = [self._queue.popleft() for _ in range(count)]
+            self._flushing = count
+            if count:
+                self._queue_not_full.notify_all()
+            return spans
 
+    def _start_periodic(self):
+        # created on the loop, Tornado 4 binds it to IOLoop.current()
+        from tornado.ioloop import PeriodicCallback
+        self._periodic = PeriodicCallback(self._flush_on_loop,
+                                          self.flush_interval * 1000)
+        self._periodic.start()
+        if self.spill is not None:
+            self._adopt_orphans()
 
-    def _submit(self, span):
-        if not span:
+    def _adopt_orphans(self):
+        """Take over the spilled spans of processes that exited."""
+        # noinspection PyBroadException
+        try:
+            moved = self.spill.adopt_orphans(self._spill_path)
+        except Exception:
+            self.logger.exception('Failed to adopt spilled spans')
+            return
+        if moved:
+            self.logger.info('Adopted %d spilled batches of exited processes',
+                             moved)
+
+    def _flush_on_loop(self):
+        """
+        Submit the queued spans from the io_loop, without ever blocking it.
+        Spans stay queued while the in-flight window is full.
+        """
+        self._flush_scheduled = False
+        while True:
+            if self.max_inflight and self.agent is None:
+                with self._inflight_cond:
+                    if self._inflight >= self.max_inflight:
+                        break
+            with self._queue_cond:
+                count = min(self.batch_size, len(self._queue))
+                if not count:
+                    break
+                spans = [self._queue.popleft() for _ in range(count)]
+                self._flushing = count
+            # noinspection PyBroadException
+            try:
+                self._submit(spans)
+            except Exception:
+                self.logger.exception('Failed to flush spans')
+            with self._queue_cond:
+                self._flushing = 0
+            self._recycle(spans)
+        if self._overflow:
+            self._spill_overflow()
+        if self._traces or self._merged:
+            self._flush_lingering()
+        if self._packet:
+            self._send_datagram(self._process_record)
+        if self.spill is not None:
+            self._replay_spill_async()
+        self._check_drained()
+
+    def _check_drained(self):
+        """Let close() finish once the io_loop has nothing left to write."""
+        if self.stopped and not self._queue and not self._merged and \
+                not self._traces and not self._merging:
+            self._drained.set()
+
+    def _spill_overflow(self):
+        """Spill the spans dropped from the full queue, in batches."""
+        with self._queue_cond:
+            spans = list(self._overflow)
+            self._overflow.clear()
+        for start in range(0, len(spans), self.batch_size):
+            batch = spans[start:start + self.batch_size]
+            # noinspection PyBroadException
+            try:
+                self._spill(self._build_entries(batch))
+            except Exception:
+                self._count_lost(self.metrics.reporter_dropped, len(batch))
+                self.logger.exception('Failed to spill spans')
+            self._recycle(batch)
+
+    def _close_on_loop(self):
+        if self._periodic is not None:
+            self._periodic.stop()
+        # the rest is written as in-flight writes finish
+        self._flush_on_loop()
+
+    def _replay_spill_async(self):
+        """
+        Replay spilled batches from the io_loop, one async_put at a time.
+        """
+        if self._replaying or not len(self.spill) or \
+                not self._replay_limiter.check_credit(1.0):
             return
+        key, value, count = _unpack_spill_entry(self.spill.peek())
+        self._replaying = True
+        try:
+            self._algodb.async_put(
+                key, value, functools.partial(self._on_replay_finished, count))
+        except Exception as e:
+            self._replaying = False
+            self._backend_healthy = False
+            self.error_reporter.error(
+                'Failed to replay spilled traces to algo-agent: %s', e)
+
+    def _on_replay_finished(self, count, ret):
+        if ret.get('reason') == 'ok':
+            self.spill.pop()
+            self._backend_healthy = True
+            self._count_delivered(count)
+        else:
+            self._backend_healthy = False
+            self.error_reporter.error(
+                'Failed to replay spilled traces to algo-agent: %s', ret)
+        self._replaying = False
+
+    def _submit(self, spans):
+        if self.agent is not None:
+            self._submit_datagrams(spans)
+            return
+        if self.trace_linger > 0:
+            self._linger(spans)
+            entries = self._expire_traces(self._free_inflight())
+        else:
+            entries = self._build_entries(spans)
+        self._write_entries(entries)
+
+    def _write_entries(self, entries):
+        if not entries:
+            return
+        if self.spill is not None and not self._backend_healthy:
+            # keep the order of spilled and new spans while stagedb is down
+            self._spill(entries)
+        elif self.max_inflight > 0 or self.io_loop is not None:
+            self._submit_pipelined(entries)
+        else:
+            self._submit_sync(entries)
+
+    def _recycle(self, spans):
+        """Hand encoded spans back to the span pool of their tracer."""
+        pool = spans[0].tracer.span_pool if spans else None
+        if pool is not None:
+            pool.release(spans)
+
+    def _build_entries(self, spans):
+        """
+        :return: Returns a list of (key, value, span count) stagedb writes
+            for the spans.
+        """
+        if not spans:
+            return []
         with self._process_lock:
             process = self._process
+            process_record = self._process_record
             if not process:
-                return
+                return []
+        records = [record for record in map(self._encode_span, spans)
+                   if record is not None]
+        if not records:
+            return []
+        # the process descriptor is written once per batch, not per span
+        key = '/%s|batch|%x' % (process.serviceName, spans[0].span_id)
+        value = self._encode_batch(process_record, records)
+        return [(key, value, len(records))]
+
+    def _encode_span(self, span):
+        """
+        :return: Returns the span record of a span, or None if the span
+            cannot be encoded, which is counted as lost.
+        """
+        # noinspection PyBroadException
+        try:
+            return encoding.encode_span(span)
+        except Exception:
+            self._count_lost(self.metrics.reporter_failure, 1)
+            self.logger.exception('Failed to encode span %s',
+                                  span.operation_name)
+            return None
+
+    def _linger(self, spans):
+        """Encode the spans and hold them back with the rest of their trace."""
+        deadline = monotonic() + self.trace_linger
+        for span in spans:
+            record = self._encode_span(span)
+            if record is None:
+                continue
+            trace = self._traces.get(span.trace_id)
+            if trace is None:
+                trace = self._traces[span.trace_id] = (deadline, [])
+            trace[1].append(record)
+            self._lingering_spans += 1
+
+    def _flush_lingering(self):
+        """Write the traces due after the last flush of the queue."""
+        # noinspection PyBroadException
         try:
-            service_name=self._process[0]
-            key='/%s|%s'%(service_name,span.span_id)
-            self._algodb.put('%s'%key,'%s'%span)
-            print key,self._process
-            self.metrics.reporter_success(1)
+            self._write_entries(self._expire_traces(self._free_inflight()))
+        except Exception:
+            self.logger.exception('Failed to flush spans')
+
+    def _expire_traces(self, limit=None):
+        """
+        :param limit: how many traces to write at most, or None
+        :return: Returns a list of (key, value, span count) stagedb writes
+            for the traces whose linger window is over, or for all traces
+            once the reporter is stopped.
+        """
+        with self._process_lock:
+            process = self._process
+            process_record = self._process_record
+        if not process:
+            self._traces.clear()
+            self._lingering_spans = 0
+            self._merged.clear()
+            return []
+        entries = []
+        while self._merged and (limit is None or len(entries) < limit):
+            key, records, count = self._merged.popleft()
+            if key is None:
+                entries.append(self._batch_entry(
+                    process.serviceName, process_record, records))
+            else:
+                entries.append(
+                    (key, self._encode_batch(process_record, records), count))
+        now = monotonic()
+        while self._traces and (limit is None or len(entries) < limit):
+            trace_id = next(iter(self._traces))
+            deadline, records = self._traces[trace_id]
+            # the oldest traces leave early when too many are lingering
+            if deadline > now and not self.stopped and \
+                    len(self._traces) <= self.trace_cache_size:
+                break
+            del self._traces[trace_id]
+            self._lingering_spans -= len(records)
+            entry = self._trace_entry(
+                process.serviceName, process_record, trace_id, records)
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    def _trace_entry(self, service_name, process_record, trace_id, records):
+        """
+        :return: Returns the (key, value, span count) stagedb write for the
+            spans of a trace, merged with its spans written before, or None
+            if the spans wait for the stored trace to be read back.
+        """
+        key = '/%s|trace|%x' % (service_name, trace_id)
+        count = len(records)
+        if trace_id in self._merging:
+            self._merging[trace_id].extend(records)
+            return None
+        written = self._written.pop(trace_id, None)
+        if written is not None:
+            records = written + records
+        elif self._evicted.pop(trace_id, False):
+            if self.io_loop is not None:
+                self._merging[trace_id] = records
+                self._read_trace_async(key, trace_id)
+                return None
+            stored = self._read_trace(key)
+            if stored is None:
+                self._evicted[trace_id] = True
+                return self._batch_entry(
+                    service_name, process_record, records)
+            records = stored + records
+        self._remember_trace(trace_id, records)
+        return key, self._encode_batch(process_record, records), count
+
+    def _batch_entry(self, service_name, process_record, records):
+        """
+        :return: Returns the (key, value, span count) stagedb write for
+            late spans of a trace that could not be read back, keyed like
+            a batch so that the stored trace is left alone.
+        """
+        span_id = encoding.decode_span(records[0], with_tags=False).span_id
+        key = '/%s|batch|%x' % (service_name, span_id)
+        return key, self._encode_batch(process_record, records), len(records)
+
+    def _remember_trace(self, trace_id, records):
+        self._written[trace_id] = records
+        if len(self._written) > self.trace_cache_size:
+            evicted, _ = self._written.popitem(last=False)
+            self._evicted[evicted] = True
+            if len(self._evicted) > self.trace_cache_size * _TRACE_ID_HISTORY:
+                self._evicted.popitem(last=False)
+
+    def _read_trace(self, key):
+        """
+        Read a trace back from the flusher thread.
+
+        :return: Returns the span records stored under key, an empty list
+            if there are none, or None if they could not be read.
+        """
+        replies = []
+        done = threading.Event()
+
+        def on_read(ret):
+            replies.append(ret)
+            done.set()
+
+        try:
+            self._algodb.async_get(key, on_read)
         except Exception as e:
-            print str(e)
-            self.metrics.reporter_failure(1)
+            on_read({'reason': str(e)})
+        if not done.wait(self.inflight_timeout):
             self.error_reporter.error(
-                'Failed to submit traces to algo-agent: %s', e)
+                'Timed out reading traces from algo-agent')
+            return None
+        return self._stored_records(replies[0])
+
+    def _read_trace_async(self, key, trace_id):
+        callback = functools.partial(self._on_trace_read, key, trace_id)
+        try:
+            self._algodb.async_get(key, callback)
+        except Exception as e:
+            callback({'reason': str(e)})
 
-    def _send(self, batch):
-        return self.agent.emitBatch(batch)
+    def _on_trace_read(self, key, trace_id, ret):
+        # called back on a stagedb thread, the merge belongs to the io_loop
+        self.io_loop.add_callback(self._merge_trace, key, trace_id, ret)
 
-    def close(self):
+    def _merge_trace(self, key, trace_id, ret):
+        records = self._merging.pop(trace_id)
+        count = len(records)
+        stored = self._stored_records(ret)
+        if stored is None:
+            self._evicted[trace_id] = True
+            # keyed like a batch by _expire_traces, the trace is left alone
+            key = None
+        else:
+            records = stored + records
+            self._remember_trace(trace_id, records)
+        # written by the next flush, within the in-flight window
+        self._merged.append((key, records, count))
+        if self.stopped:
+            self._flush_lingering()
+            self._check_drained()
+
+    def _stored_records(self, ret):
+        """
+        :param ret: the reply of async_get for a stored trace
+        :return: Returns the span records of the trace, an empty list if
+            none is stored, or None if it could not be read or decoded.
+        """
+        reason = ret.get('reason')
+        if reason == 'notfound':
+            return []
+        if reason != 'ok':
+            self.error_reporter.error(
+                'Failed to read traces from algo-agent: %s', ret)
+            return None
+        if not ret.get('ret'):
+            return []
+        # noinspection PyBroadException
+        try:
+            return encoding.batch_records(ret['ret'])
+        except Exception as e:
+            self.error_reporter.error('Failed to decode stored trace: %s', e)
+            return None
+
+    def _encode_batch(self, process_record, records):
+        envelope = encoding.encode_batch(process_record, records)
+        if not self.compression or \
+                len(envelope) < self.compression_threshold:
+            return envelope
+        started = monotonic()
+        compressed = encoding.compress_batch(
+            envelope, use_dict=self.compression == COMPRESSION_ZLIB_DICT)
+        self.metrics.compression_time((monotonic() - started) * 1000000)
+        self.metrics.compression_ratio(float(len(envelope)) / len(compressed))
+        return compressed
+
+    def _submit_sync(self, entries):
+        for entry in entries:
+            key, value, count = entry
+            try:
+                self._algodb.put(key, value)
+                self._backend_healthy = True
+                self._count_delivered(count)
+            except Exception as e:
+                self._on_write_failed(entry)
+                self.error_reporter.error(
+                    'Failed to submit traces to algo-agent: %s', e)
+
+    def _submit_pipelined(self, entries):
+        """
+        Issue async_put for every entry without waiting for the replies.
+        Completions are counted by _on_put_finished.
+        """
+        for entry in entries:
+            key, value, count = entry
+            if self.trace_linger > 0 and self._defer_trace_write(entry):
+                continue
+            if not self._acquire_inflight(count):
+                # stagedb is slow rather than failing, spill like a span
+                # that does not fit into the queue
+                if self.spill is not None:
+                    self._spill([entry])
+                else:
+                    self._count_lost(self.metrics.reporter_dropped, count)
+                continue
+            if self.trace_linger > 0:
+                with self._inflight_cond:
+                    self._trace_writes[key] = None
+            self._put_async(entry)
+
+    def _put_async(self, entry):
+        """Issue the async_put of an entry that holds an in-flight slot."""
+        key, value, count = entry
+        try:
+            self._algodb.async_put(
+                key, value, functools.partial(self._on_put_finished, entry))
+        except Exception as e:
+            self._on_put_finished(entry, {'reason': str(e)})
+
+    def _defer_trace_write(self, entry):
+        """
+        Hold back the write of a trace while an older version of it is in
+        flight, as the two async_puts might complete in either order.
+
+        :return: Returns True if the entry is written by _on_put_finished.
+        """
+        key, value, count = entry
+        with self._inflight_cond:
+            if key not in self._trace_writes:
+                return False
+            deferred = self._trace_writes[key]
+            if deferred is not None:
+                # replaced by the entry, which holds its spans as well
+                count += deferred[2]
+            self._trace_writes[key] = (key, value, count)
+            return True
+
+    def _submit_datagrams(self, spans):
+        """
+        Pack encoded spans into datagrams of at most agent.max_packet_size
+        bytes. A partially filled datagram is kept until the next flush, and
+        sent once a flush returns less than a full batch, i.e. when the
+        flush interval elapsed or the reporter is stopping.
+        """
+        with self._process_lock:
+            process_record = self._process_record
+            if process_record is None:
+                return
+        limit = self.agent.max_packet_size - len(process_record) - \
+            _ENVELOPE_OVERHEAD
+        for span in spans:
+            record = self._encode_span(span)
+            if record is None:
+                continue
+            size = len(record) + _RECORD_OVERHEAD
+            if size > limit:
+                self._count_lost(self.metrics.reporter_dropped, 1)
+                continue
+            if self._packet_size + size > limit:
+                self._send_datagram(process_record)
+            self._packet.append(record)
+            self._packet_size += size
+        if self._packet and len(spans) < self.batch_size:
+            self._send_datagram(process_record)
+
+    def _send_datagram(self, process_record):
+        count = len(self._packet)
+        packet = self._encode_batch(process_record, self._packet)
+        self._packet = []
+        self._packet_size = 0
+        try:
+            self.agent.write(packet)
+            self._count_delivered(count)
+        except socket.error as e:
+            self._count_lost(self.metrics.reporter_socket, count)
+            self.error_reporter.error(
+                'Failed to send traces to algo-agent: %s', e)
+
+    def _free_inflight(self):
+        """
+        :return: Returns how many writes fit into the in-flight window of
+            an io_loop, which must not wait for a slot, or None.
+        """
+        if self.io_loop is None or not self.max_inflight:
+            return None
+        with self._inflight_cond:
+            return max(self.max_inflight - self._inflight, 0)
+
+    def _acquire_inflight(self, count):
+        # an io_loop never waits for a slot
+        timeout = self.inflight_timeout if self.io_loop is None else 0
+        deadline = monotonic() + timeout
+        with self._inflight_cond:
+            while self.max_inflight and self._inflight >= self.max_inflight:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self._inflight_cond.wait(remaining)
+            self._inflight += 1
+            self._inflight_spans += count
+            return True
+
+    def _release_inflight(self, count):
+        with self._inflight_cond:
+            self._inflight -= 1
+            self._inflight_spans -= count
+            self._inflight_cond.notify_all()
+
+    def _on_put_finished(self, entry, ret):
+        ok = ret.get('reason') == 'ok'
+        deferred = None
+        with self._inflight_cond:
+            if entry[0] in self._trace_writes:
+                deferred = self._trace_writes.pop(entry[0])
+            if deferred is not None:
+                if not ok:
+                    # the newer version of the trace holds these spans too
+                    deferred = deferred[:2] + (deferred[2] + entry[2],)
+                # the deferred write takes over the in-flight slot
+                self._trace_writes[entry[0]] = None
+                self._inflight += 1
+                self._inflight_spans += deferred[2]
+        if ok:
+            self._backend_healthy = True
+            self._count_delivered(entry[2])
+        else:
+            if deferred is None:
+                self._on_write_failed(entry)
+            self.error_reporter.error(
+                'Failed to submit traces to algo-agent: %s', ret)
+        # counted before the slot is free, close() waits for the slots
+        self._release_inflight(entry[2])
+        if deferred is not None:
+            self._put_async(deferred)
+        elif self.io_loop is not None and (self._queue or self.stopped):
+            # the free slot takes the spans waiting for the window
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        """Flush from the io_loop once, however many callers ask for it."""
+        with self._queue_cond:
+            if self._flush_scheduled:
+                return
+            self._flush_scheduled = True
+        self.io_loop.add_callback(self._flush_on_loop)
+
+    def _on_write_failed(self, entry):
+        if self.spill is None:
+            self._count_lost(self.metrics.reporter_failure, entry[2])
+            return
+        self._backend_healthy = False
+        self._spill([entry])
+
+    def _spill(self, entries):
+        for key, value, count in entries:
+            if self.spill.append(_pack_spill_entry(key, value, count)):
+                self.metrics.reporter_spilled(count)
+                with self._delivered_lock:
+                    self._delivered += count
+            else:
+                self._count_lost(self.metrics.reporter_dropped, count)
+
+    def _replay_spill(self):
+        """
+        Write spilled batches back to stagedb, at most spill_replay_rate per
+        second. The first write of a replay also probes whether a failing
+        stagedb has recovered.
+        """
+        while len(self.spill) and self._replay_limiter.check_credit(1.0):
+            key, value, count = _unpack_spill_entry(self.spill.peek())
+            try:
+                self._algodb.put(key, value)
+            except Exception as e:
+                self._backend_healthy = False
+                self.error_reporter.error(
+                    'Failed to replay spilled traces to algo-agent: %s', e)
+                return
+            self.spill.pop()
+            self._backend_healthy = True
+            self._count_delivered(count)
+
+    def _count_delivered(self, count):
+        self.metrics.reporter_success(count)
+        with self._delivered_lock:
+            self._delivered += count
+
+    def _count_lost(self, counter, count):
+        """Count spans the flusher took over but could not deliver."""
+        counter(count)
+        with self._delivered_lock:
+            self._lost += count
+
+    def _pending(self):
+        """
+        :return: Returns how many spans are queued, being flushed, waiting
+            in a partial datagram or a lingering trace, or in flight to
+            stagedb.
+        """
+        with self._queue_cond:
+            pending = len(self._queue) + len(self._overflow) + \
+                self._flushing
+        with self._inflight_cond:
+            pending += self._inflight_spans
+            for deferred in six.itervalues(self._trace_writes):
+                if deferred is not None:
+                    pending += deferred[2]
+        return pending + len(self._packet) + self._lingering_spans
+
+    def close(self, timeout=None):
+        """
+        Stop accepting spans and flush the buffered ones.
+
+        :param timeout: how long to wait for the flush, in seconds;
+            defaults to close_timeout
+        :return: Returns a concurrent.futures.Future that resolves to a
+            FlushResult once every buffered span is written or the
+            deadline expires. Closing the reporter again returns the same
+            Future.
+        """
+        if timeout is None:
+            timeout = self.close_timeout
+        deadline = monotonic() + timeout
         with self.stop_lock:
+            if self._close_future is not None:
+                return self._close_future
+            future = self._close_future = Future()
+            with self._delivered_lock:
+                counts = (self._delivered, self._lost)
             self.stopped = True
+        with self._queue_cond:
+            self._queue_cond.notify()
+            self._queue_not_full.notify_all()
+        if self.io_loop is not None:
+            self.io_loop.add_callback(self._close_on_loop)
+        waiter = threading.Thread(
+            target=self._wait_for_flush, args=(future, deadline, counts),
+            name='algo-reporter-close')
+        waiter.daemon = True
+        waiter.start()
+        return future
+
+    def _wait_for_flush(self, future, deadline, counts):
+        # noinspection PyBroadException
+        try:
+            if self._flusher is not None:
+                self._flusher.join(max(deadline - monotonic(), 0))
+                drained = not self._flusher.is_alive()
+            else:
+                drained = self._drained.wait(max(deadline - monotonic(), 0))
+            with self._inflight_cond:
+                while self._inflight:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    self._inflight_cond.wait(remaining)
+                drained = drained and not self._inflight
+            if drained and self.spill is not None and \
+                    not (self.io_loop is not None and self._replaying):
+                # nothing writes to the ring any more, flush it to disk
+                if self.spill.path != self._spill_path and \
+                        not len(self.spill):
+                    # an empty ring of a forked child is not worth adopting
+                    try:
+                        os.remove(self.spill.path)
+                    except OSError:
+                        pass
+                self.spill.close()
+            with self._delivered_lock:
+                flushed = self._delivered - counts[0]
+                lost = self._lost - counts[1]
+            future.set_result(FlushResult(
+                flushed=flushed, abandoned=self._pending() + lost))
+        except Exception as e:
+            future.set_exception(e)
 
 
 class ReporterMetrics(object):
@@ -131,4 +1247,47 @@ class ReporterMetrics(object):
             metrics_factory.create_counter(name='algo.spans', tags={'dropped': 'true'})
         self.reporter_socket = \
             metrics_factory.create_counter(name='algo.spans', tags={'socket_error': 'true'})
+        self.reporter_spilled = \
+            metrics_factory.create_counter(name='algo.spans', tags={'spilled': 'true'})
+        self.compression_ratio = \
+            metrics_factory.create_gauge(name='algo.reporter.compression-ratio')
+        self.compression_time = \
+            metrics_factory.create_timer(name='algo.reporter.compression-time')
+
+
+def _local_agent(channel):
+    """
+    :return: Returns the channel if it is a LocalAgentSender, else None.
+        Told apart by its max_packet_size rather than isinstance(), which
+        would import thrift in stagedb mode.
+    """
+    return channel if hasattr(channel, 'max_packet_size') else None
+
+
+def _pack_spill_entry(key, value, count):
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    return _SPILL_ENTRY.pack(len(key), count) + key + value
+
+
+def _unpack_spill_entry(data):
+    key_length, count = _SPILL_ENTRY.unpack_from(data, 0)
+    start = _SPILL_ENTRY.size
+    key = data[start:start + key_length]
+    if six.PY3:
+        key = key.decode('utf-8')
+    return key, data[start + key_length:], count
+
+
+def _index(index, key, number):
+    numbers = index.get(key)
+    if numbers is None:
+        numbers = index[key] = deque()
+    numbers.append(number)
+
 
+def _unindex(index, key):
+    numbers = index[key]
+    numbers.popleft()
+    if not numbers:
+        del index[key]
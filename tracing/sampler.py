@@ -126,6 +126,8 @@ class ProbabilisticSampler(Sampler):
         self.boundary = rate * self.max_number
 
     def is_sampled(self, trace_id, operation=''):
+        # 128-bit trace IDs are sampled on their low 64 bits
+        trace_id &= self.max_number - 1
         return trace_id < self.boundary, self._tags
 
     def close(self):
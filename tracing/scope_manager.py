@@ -0,0 +1,135 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import object
+import six
+import threading
+import traceback
+
+from opentracing.ext import tags as ext_tags
+
+
+class Scope(object):
+    """
+    A Scope makes a span the active span of a ScopeManager until it is
+    closed, then restores the span that was active before. Used as a
+    context manager, it records an exception raised in its block on the
+    span as an error, logging its type and message, and its formatted
+    traceback if the tracer's log_error_stack is set. The exception itself
+    is not kept, as it would hold the frames of its traceback alive until
+    the span is reported.
+    """
+
+    __slots__ = ['manager', 'span', '_finish_on_close', '_previous']
+
+    def __init__(self, manager, span, finish_on_close, previous):
+        self.manager = manager
+        self.span = span
+        self._finish_on_close = finish_on_close
+        # scopes of a thread form a stack linked through _previous
+        self._previous = previous
+
+    def close(self):
+        """Deactivate the span and finish it if the scope owns it."""
+        self.manager._deactivate(self)
+        if self._finish_on_close:
+            self.span.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        span = self.span
+        if exc_type is not None and span.is_recorded():
+            span.set_tag(ext_tags.ERROR, True)
+            fields = {
+                'event': 'error',
+                'error.kind': exc_type.__name__,
+                'message': _message(exc_val),
+            }
+            if span.tracer.log_error_stack:
+                fields['stack'] = ''.join(traceback.format_tb(exc_tb))
+            span.log_kv(fields)
+        # close(), inlined as this runs for every span
+        self.manager._deactivate(self)
+        if self._finish_on_close:
+            span.finish()
+
+
+def _message(exc_val):
+    # noinspection PyBroadException
+    try:
+        return six.text_type(exc_val)
+    except Exception:
+        return repr(exc_val)
+
+
+class ScopeManager(object):
+    """
+    ScopeManager keeps track of the active span, the implicit parent of
+    spans started by the Tracer.
+    """
+
+    def activate(self, span, finish_on_close):
+        """
+        Make span the active span.
+
+        :param span: the Span to activate
+        :param finish_on_close: finish the span when the scope is closed
+        :return: Returns a Scope, to be closed when the span's work is done.
+        """
+        raise NotImplementedError()
+
+    @property
+    def active(self):
+        """
+        :return: Returns the active Scope, or None.
+        """
+        raise NotImplementedError()
+
+    def _deactivate(self, scope):
+        raise NotImplementedError()
+
+
+class _ThreadScope(threading.local):
+    # the class attribute saves getattr() with a default in every thread
+    scope = None
+
+
+class ThreadLocalScopeManager(ScopeManager):
+    """
+    Keeps a stack of active scopes per thread. Spans passed to another
+    thread have to be activated there explicitly.
+    """
+
+    def __init__(self):
+        self._local = _ThreadScope()
+
+    def activate(self, span, finish_on_close):
+        local = self._local
+        scope = Scope(self, span, finish_on_close, local.scope)
+        local.scope = scope
+        return scope
+
+    @property
+    def active(self):
+        return self._local.scope
+
+    def _deactivate(self, scope):
+        local = self._local
+        # a scope closed out of order leaves the stack alone
+        if local.scope is scope:
+            local.scope = scope._previous
@@ -1,14 +1,32 @@
 from __future__ import absolute_import
 
-from builtins import str
 import six
+import sys
 import threading
 import time
+import weakref
+from collections import deque
 
 import opentracing
 from opentracing.ext import tags as ext_tags
-from . import codecs, thrift
-from .constants import SAMPLED_FLAG, DEBUG_FLAG
+from . import codecs
+from .constants import SAMPLED_FLAG, DEBUG_FLAG, RECORD_FLAG, \
+    DEFAULT_SPAN_POOL_SIZE
+from .utils import get_boolean, monotonic_ns
+
+
+# SpanPool needs reference counts to tell if a span is still in use
+POOLING_SUPPORTED = hasattr(sys, 'getrefcount')
+
+# a span with either flag is recorded and reported
+_RECORDED_FLAGS = SAMPLED_FLAG | RECORD_FLAG
+
+# tags that are also kept in fields of the Span, see Span._capture_tag()
+_CAPTURED_TAGS = frozenset([
+    ext_tags.SPAN_KIND, ext_tags.ERROR,
+    ext_tags.PEER_ADDRESS, ext_tags.PEER_HOSTNAME, ext_tags.PEER_HOST_IPV4,
+    ext_tags.PEER_HOST_IPV6, ext_tags.PEER_PORT, ext_tags.PEER_SERVICE,
+])
 
 
 class Span(opentracing.Span):
@@ -16,18 +34,37 @@ class Span(opentracing.Span):
 
     __slots__ = ['_tracer', '_context',
                  'operation_name', 'start_time', 'end_time',
-                 'logs', 'tags', 'update_lock']
+                 'duration_ns', '_start_ns',
+                 'kind', 'has_error', 'peer', 'sampling_priority',
+                 'logs', 'tags', 'references', 'update_lock']
 
     def __init__(self, context, tracer, operation_name,
-                 tags=None, start_time=None):
+                 tags=None, start_time=None, references=None):
         super(Span, self).__init__(context=context, tracer=tracer)
-        self.operation_name = operation_name
-        self.start_time = start_time or time.time()
-        self.end_time = None
         self.update_lock = threading.Lock()
-        # we store tags and logs as Thrift objects to avoid extra allocations
+        # tags and logs are kept raw, as (key, value) and (timestamp,
+        # key_values) tuples; the reporter converts them when encoding
         self.tags = []
         self.logs = []
+        self._start(operation_name, tags, start_time, references)
+
+    def _start(self, operation_name, tags, start_time, references):
+        self.operation_name = operation_name
+        self.references = references
+        # start_time anchors the span to the wall clock, its duration is
+        # measured on the monotonic clock unless the caller passes times
+        if start_time:
+            self.start_time = start_time
+            self._start_ns = None
+        else:
+            self.start_time = time.time()
+            self._start_ns = monotonic_ns()
+        self.end_time = None
+        self.duration_ns = None
+        self.kind = None
+        self.has_error = False
+        self.peer = None
+        self.sampling_priority = None
         if tags:
             for k, v in six.iteritems(tags):
                 self.set_tag(k, v)
@@ -53,43 +90,59 @@ class Span(opentracing.Span):
         :param finish_time: an explicit Span finish timestamp as a unix
             timestamp per time.time()
         """
-        if not self.is_sampled():
+        if not self.is_recorded():
             return
 
-        self.end_time = finish_time or time.time()  # no locking
+        if finish_time is None and self._start_ns is not None:
+            self.duration_ns = monotonic_ns() - self._start_ns
+            self.end_time = self.start_time + self.duration_ns / 1e9
+        else:
+            self.end_time = finish_time or time.time()  # no locking
         self.tracer.report_span(self)
 
     def set_tag(self, key, value):
         """
+        The value is stored as-is; it is converted to a string and
+        truncated to max_tag_value_length when the span is reported.
+
         :param key:
         :param value:
         """
-        with self.update_lock:
-            if key == ext_tags.SAMPLING_PRIORITY:
+        if key == ext_tags.SAMPLING_PRIORITY:
+            with self.update_lock:
+                self.sampling_priority = value
                 if value > 0:
                     self.context.flags |= SAMPLED_FLAG | DEBUG_FLAG
                 else:
                     self.context.flags &= ~SAMPLED_FLAG
-            elif self.is_sampled():
-                tag = thrift.make_string_tag(
-                    key=key,
-                    value=str(value),
-                    max_length=self.tracer.max_tag_value_length,
-                )
-                self.tags.append(tag)
+            return self
+        if key in _CAPTURED_TAGS:
+            self._capture_tag(key, value)
+        if self.is_recorded():
+            self.tags.append((key, value))  # list.append is atomic
         return self
 
+    def _capture_tag(self, key, value):
+        if key == ext_tags.SPAN_KIND:
+            self.kind = value
+        elif key == ext_tags.ERROR:
+            self.has_error = get_boolean(value, bool(value))
+        else:
+            with self.update_lock:
+                if self.peer is None:
+                    self.peer = {}
+                self.peer[key] = value
+
     def log_kv(self, key_values, timestamp=None):
-        if self.is_sampled():
-            timestamp = timestamp if timestamp else time.time()
+        """
+        key_values is kept by reference until the span is reported, and
+        must not be modified by the caller afterwards.
+        """
+        if self.is_recorded():
             # TODO handle exception logging, 'python.exception.type' etc.
-            log = thrift.make_log(
-                timestamp=timestamp if timestamp else time.time(),
-                fields=key_values,
-                max_length=self._tracer.max_tag_value_length,
-            )
-            with self.update_lock:
-                self.logs.append(log)
+            if not timestamp:
+                timestamp = self._now()
+            self.logs.append((timestamp, key_values))
         return self
 
     def set_baggage_item(self, key, value):
@@ -97,7 +150,7 @@ class Span(opentracing.Span):
         new_context = self.context.with_baggage_item(key=key, value=value)
         with self.update_lock:
             self._context = new_context
-        if self.is_sampled():
+        if self.is_recorded():
             logs = {
                 'event': 'baggage',
                 'key': key,
@@ -109,6 +162,11 @@ class Span(opentracing.Span):
             self.log_kv(key_values=logs)
         return self
 
+    def _now(self):
+        if self._start_ns is None:
+            return time.time()
+        return self.start_time + (monotonic_ns() - self._start_ns) / 1e9
+
     def get_baggage_item(self, key):
         return self.context.baggage.get(key)
 
@@ -118,18 +176,20 @@ class Span(opentracing.Span):
     def is_debug(self):
         return self.context.flags & DEBUG_FLAG == DEBUG_FLAG
 
+    def is_recorded(self):
+        """
+        :return: Returns True if the span's tags and logs are kept and it
+            is reported when finished: it is sampled, or its tracer records
+            every trace for tail sampling.
+        """
+        return self.context.flags & _RECORDED_FLAGS != 0
+
     def is_rpc(self):
-        for tag in self.tags:
-            if tag.key == ext_tags.SPAN_KIND:
-                return tag.vStr == ext_tags.SPAN_KIND_RPC_CLIENT or \
-                    tag.vStr == ext_tags.SPAN_KIND_RPC_SERVER
-        return False
+        return self.kind == ext_tags.SPAN_KIND_RPC_CLIENT or \
+            self.kind == ext_tags.SPAN_KIND_RPC_SERVER
 
     def is_rpc_client(self):
-        for tag in self.tags:
-            if tag.key == ext_tags.SPAN_KIND:
-                return tag.vStr == ext_tags.SPAN_KIND_RPC_CLIENT
-        return False
+        return self.kind == ext_tags.SPAN_KIND_RPC_CLIENT
 
     @property
     def trace_id(self):
@@ -169,3 +229,140 @@ class Span(opentracing.Span):
         else:
             self.log(event=message)
         return self
+
+
+class SpanPool(object):
+    """
+    SpanPool recycles reported spans, saving Tracer.start_span() the
+    allocation of a Span with its lock and tag and log lists.
+
+    The reporter offers each span to the pool once it is encoded. A span
+    is only taken if nothing else refers to it any more, strongly or
+    through a weakref, so a span that the application still holds after
+    finish() is never reused under it. The check relies on
+    sys.getrefcount() and pooling is therefore not available on
+    interpreters without it, see POOLING_SUPPORTED. The pool also stays
+    empty if getrefcount() turns out not to count a held reference.
+    """
+
+    def __init__(self, capacity=DEFAULT_SPAN_POOL_SIZE):
+        """
+        :param capacity: max number of free spans kept
+        """
+        self.capacity = capacity
+        # shared by all threads, deque.append() and pop() are atomic
+        self._free = deque()
+        # the count of a span only referenced by release() itself, measured
+        # the way release() does it since interpreters differ
+        self._free_refcount = self._refcount([object()])
+        held = object()
+        if self._refcount([held]) <= self._free_refcount:
+            # an extra reference went unseen, reusing spans would be unsafe
+            self.capacity = 0
+
+    @staticmethod
+    def _refcount(probes):
+        while probes:
+            probe = probes.pop()
+            return sys.getrefcount(probe)
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self, context, tracer, operation_name,
+                tags=None, start_time=None, references=None):
+        """
+        :return: Returns a recycled Span started with the given arguments,
+            or a new Span if the pool is empty.
+        """
+        try:
+            span = self._free.pop()
+        except IndexError:
+            return Span(context=context, tracer=tracer,
+                        operation_name=operation_name, tags=tags,
+                        start_time=start_time, references=references)
+        span._context = context
+        span._tracer = tracer
+        span._start(operation_name, tags, start_time, references)
+        return span
+
+    def release(self, spans):
+        """
+        Offer reported spans for reuse. Spans that are referenced from
+        anywhere but the list are left alone.
+
+        :param spans: a list of spans, emptied by the call
+        :return: Returns the number of spans taken into the pool.
+        """
+        taken = 0
+        while spans:
+            span = spans.pop()
+            if sys.getrefcount(span) > self._free_refcount or \
+                    weakref.getweakrefcount(span) or \
+                    span.update_lock.locked() or \
+                    len(self._free) >= self.capacity:
+                continue
+            # drop what the span refers to, the pool must not keep it alive
+            del span.tags[:]
+            del span.logs[:]
+            span.references = None
+            span.peer = None
+            span._context = None
+            self._free.append(span)
+            taken += 1
+        return taken
+
+
+class UnsampledSpan(Span):
+    """
+    A span of a trace that is not sampled. It carries its context so that
+    the trace can still be propagated with Tracer.inject(), but it has no
+    lock, tags or logs of its own, and is never reported.
+
+    Unsampled children share their parent's SpanContext, which is only
+    ever replaced, not modified, by set_baggage_item(). The trace can
+    therefore not be upgraded to sampled by a sampling.priority tag set on
+    an UnsampledSpan; pass the tag to Tracer.start_span() instead.
+    """
+
+    __slots__ = []
+
+    tags = ()
+    logs = ()
+    references = None
+    kind = None
+    has_error = False
+    peer = None
+    sampling_priority = None
+
+    def __init__(self, context, tracer, operation_name):
+        # skip Span.__init__, an unsampled span allocates nothing else
+        self._context = context
+        self._tracer = tracer
+        self.operation_name = operation_name
+
+    def set_operation_name(self, operation_name):
+        self.operation_name = operation_name
+        return self
+
+    def finish(self, finish_time=None):
+        pass
+
+    def set_tag(self, key, value):
+        return self
+
+    def log_kv(self, key_values, timestamp=None):
+        return self
+
+    def set_baggage_item(self, key, value):
+        self._context = self._context.with_baggage_item(key=key, value=value)
+        return self
+
+    def is_sampled(self):
+        return False
+
+    def is_recorded(self):
+        return False
+
+    def is_debug(self):
+        return False
@@ -0,0 +1,236 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import object
+import mmap
+import os
+import struct
+import threading
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+_MAGIC = b'ASPL'
+_HEADER = struct.Struct('!4sIII')  # magic, head, tail, count
+_LENGTH = struct.Struct('!I')
+_WRAP = 0xffffffff
+
+
+class SpillBuffer(object):
+    """
+    SpillBuffer is a fixed-size FIFO of byte strings kept in a memory-mapped
+    ring file on local disk. The reporter moves encoded spans here when its
+    queue is full or stagedb is failing, and replays them later.
+
+    Each entry is a u32 length followed by the data. An entry that does not
+    fit before the end of the ring is written at its start, and a _WRAP
+    length marks the skipped tail. The read and write offsets are kept in
+    the file header, so entries survive a restart of the process.
+
+    The process that opened a ring file holds an flock() on it until the
+    ring is closed or the process exits. Other processes sharing the
+    spill path, e.g. forked workers each with a ring of their own, move
+    the entries of a ring file that is no longer held into theirs with
+    adopt_orphans(), and remove the file. Without fcntl, rings are never
+    adopted.
+    """
+
+    def __init__(self, path, size):
+        """
+        :param path: the ring file, created if it does not exist
+        :param size: capacity of the ring in bytes
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        # another process holding the file is not ours to stop, the lock
+        # only keeps the file from being adopted
+        _try_lock(fd)
+        self._open(path, size, fd)
+
+    @classmethod
+    def _open_orphan(cls, path):
+        """
+        :return: Returns the ring in the file at path, or None if the file
+            is still held by its process or is not a ring file.
+        """
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError:
+            return None
+        try:
+            size = os.fstat(fd).st_size - _HEADER.size
+            if size <= 0 or not _try_lock(fd):
+                os.close(fd)
+                return None
+        except OSError:
+            os.close(fd)
+            return None
+        ring = cls.__new__(cls)
+        ring._open(path, size, fd)
+        return ring
+
+    def _open(self, path, size, fd):
+        """Map the ring file open at fd, which is closed afterwards."""
+        self.path = path
+        self.size = size
+        self._lock = threading.Lock()
+        self._closed = False
+        total = _HEADER.size + size
+        try:
+            if os.fstat(fd).st_size != total:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, total)
+            # the mapping keeps a duplicate of fd, and with it the flock()
+            self._mmap = mmap.mmap(fd, total)
+        finally:
+            os.close(fd)
+        magic, self._head, self._tail, self._count = \
+            _HEADER.unpack_from(self._mmap, 0)
+        if magic != _MAGIC or self._head > size or self._tail > size:
+            self._head, self._tail, self._count = 0, 0, 0
+            self._write_header()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, data):
+        """
+        Add an entry at the end of the ring.
+
+        :return: Returns False if the ring has no room for the entry.
+        """
+        needed = _LENGTH.size + len(data)
+        with self._lock:
+            if self._count == 0:
+                self._head, self._tail = 0, 0
+            pos = self._tail
+            if self._count and pos <= self._head:
+                if self._head - pos < needed:
+                    return False
+            elif self.size - pos < needed:
+                if self._count and self._head < needed:
+                    return False
+                if self.size - pos >= _LENGTH.size:
+                    _LENGTH.pack_into(self._mmap, _HEADER.size + pos, _WRAP)
+                pos = 0
+            _LENGTH.pack_into(self._mmap, _HEADER.size + pos, len(data))
+            start = _HEADER.size + pos + _LENGTH.size
+            self._mmap[start:start + len(data)] = data
+            self._tail = pos + needed
+            self._count += 1
+            self._write_header()
+            return True
+
+    def peek(self):
+        """
+        :return: Returns the oldest entry, or None if the ring is empty.
+        """
+        with self._lock:
+            if not self._count:
+                return None
+            pos, length = self._locate_head()
+            start = _HEADER.size + pos + _LENGTH.size
+            return bytes(self._mmap[start:start + length])
+
+    def pop(self):
+        """Remove the oldest entry."""
+        with self._lock:
+            if not self._count:
+                return
+            pos, length = self._locate_head()
+            self._head = pos + _LENGTH.size + length
+            self._count -= 1
+            if not self._count:
+                self._head, self._tail = 0, 0
+            self._write_header()
+
+    def close(self):
+        """Flush the ring to disk and unmap it, once."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._mmap.flush()
+            self._mmap.close()
+
+    def adopt_orphans(self, path):
+        """
+        Move the entries of the ring files at path and at path.<pid> that
+        no process holds any more into this ring, and remove the files
+        that were emptied. A file whose entries do not all fit is left
+        with the rest, for a later call.
+
+        :param path: the spill path the ring files were derived from
+        :return: Returns how many entries were moved.
+        """
+        directory, name = os.path.split(path)
+        try:
+            names = os.listdir(directory or os.curdir)
+        except OSError:
+            return 0
+        moved = 0
+        for candidate in names:
+            suffix = candidate[len(name) + 1:]
+            if candidate != name and not (
+                    candidate.startswith(name + '.') and suffix.isdigit()):
+                continue
+            candidate = os.path.join(directory, candidate)
+            if os.path.abspath(candidate) == os.path.abspath(self.path):
+                continue
+            orphan = SpillBuffer._open_orphan(candidate)
+            if orphan is None:
+                continue
+            try:
+                while len(orphan):
+                    if not self.append(orphan.peek()):
+                        break
+                    orphan.pop()
+                    moved += 1
+                if not len(orphan):
+                    # removed while held, so nobody adopts it meanwhile
+                    os.remove(candidate)
+            except OSError:
+                pass
+            finally:
+                orphan.close()
+        return moved
+
+    def _locate_head(self):
+        pos = self._head
+        if self.size - pos >= _LENGTH.size:
+            length = _LENGTH.unpack_from(self._mmap, _HEADER.size + pos)[0]
+            if length != _WRAP:
+                return pos, length
+        return 0, _LENGTH.unpack_from(self._mmap, _HEADER.size)[0]
+
+    def _write_header(self):
+        _HEADER.pack_into(self._mmap, 0, _MAGIC, self._head, self._tail,
+                          self._count)
+
+
+def _try_lock(fd):
+    """
+    :return: Returns True if this process now holds the file open at fd,
+        False if another process holds it or it cannot be told.
+    """
+    if fcntl is None:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        return False
+    return True
@@ -0,0 +1,262 @@
+# Copyright (c) 2016 Uber Technologies, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import absolute_import
+
+from builtins import object
+import os
+import threading
+from collections import OrderedDict
+
+from opentracing.ext import tags as ext_tags
+
+from .constants import (
+    DEFAULT_TAIL_SAMPLING_MAX_BYTES,
+    DEFAULT_TAIL_SAMPLING_SPAN_OVERHEAD,
+    DEFAULT_TAIL_SAMPLING_TRACE_TIMEOUT,
+)
+from .metrics import Metrics, LegacyMetricsFactory
+from .reporter import NullReporter
+from .utils import AT_FORK_SUPPORTED, monotonic, register_after_fork
+
+# How many decided traces TailSamplingReporter remembers, so spans finished
+# after their trace was decided follow the decision
+_DECISION_CACHE_SIZE = 4096
+
+
+class TailSamplingPolicy(object):
+    """
+    Decides whether TailSamplingReporter keeps a finished trace.
+    """
+
+    def keep(self, root, spans):
+        """
+        :param root: the local root span of the trace, or None if the trace
+            was evicted from the buffer before its root span finished
+        :param spans: the buffered spans of the trace, including root
+        :return: Returns True to keep the trace.
+        """
+        raise NotImplementedError()
+
+
+class LatencyPolicy(TailSamplingPolicy):
+    """Keeps traces whose root span took at least threshold seconds."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def keep(self, root, spans):
+        if root is not None:
+            return root.end_time - root.start_time >= self.threshold
+        # without the root, the slowest span is the best guess
+        return any(span.end_time - span.start_time >= self.threshold
+                   for span in spans)
+
+    def __str__(self):
+        return 'LatencyPolicy(%s)' % self.threshold
+
+
+class ErrorPolicy(TailSamplingPolicy):
+    """Keeps traces with a span tagged as error."""
+
+    def keep(self, root, spans):
+        return any(span.has_error for span in spans)
+
+    def __str__(self):
+        return 'ErrorPolicy()'
+
+
+class OperationPolicy(TailSamplingPolicy):
+    """Keeps traces with a span of one of the given operations."""
+
+    def __init__(self, operation_names):
+        self.operation_names = frozenset(operation_names)
+
+    def keep(self, root, spans):
+        return any(span.operation_name in self.operation_names
+                   for span in spans)
+
+    def __str__(self):
+        return 'OperationPolicy(%s)' % sorted(self.operation_names)
+
+
+class _TraceBuffer(object):
+    __slots__ = ['spans', 'updated']
+
+    def __init__(self):
+        self.spans = []
+        self.updated = 0
+
+
+class TailSamplingReporter(NullReporter):
+    """
+    Buffers the spans of every trace until its local root span finishes,
+    i.e. a span without a parent or an RPC server span, and then reports
+    the whole trace to the wrapped reporter if any of the policies keeps
+    it. Debug traces are always kept, and so are the traces the tracer's
+    sampler sampled, as other services were told to record them.
+
+    The tracer has to be created with record_all=True for the spans of
+    unsampled traces to be recorded at all. They are reported with the
+    RECORD_FLAG instead of the sampled flag, which is not propagated.
+    Buffered spans are charged span_overhead bytes each. When the buffer exceeds max_bytes, or a trace
+    has had no span finished for trace_timeout seconds, the least recently
+    updated traces are decided on the spans buffered so far. Those checks
+    run whenever a span is reported.
+    """
+
+    def __init__(self, reporter, policies,
+                 max_bytes=DEFAULT_TAIL_SAMPLING_MAX_BYTES,
+                 span_overhead=DEFAULT_TAIL_SAMPLING_SPAN_OVERHEAD,
+                 trace_timeout=DEFAULT_TAIL_SAMPLING_TRACE_TIMEOUT,
+                 metrics=None, metrics_factory=None):
+        """
+        :param reporter: the Reporter kept traces are reported to
+        :param policies: a list of TailSamplingPolicy, a trace is kept if
+            any of them keeps it
+        :param max_bytes: the memory ceiling of the buffer, in bytes
+        :param span_overhead: the memory charged for a buffered span, in
+            bytes
+        :param trace_timeout: how long a trace is buffered after its last
+            span finished, in seconds
+        :param metrics: an instance of Metrics class, or None. This parameter
+            has been deprecated, please use metrics_factory instead.
+        :param metrics_factory: an instance of MetricsFactory class, or None.
+        """
+        self.reporter = reporter
+        self.policies = list(policies)
+        self.max_bytes = max_bytes
+        self.span_overhead = span_overhead
+        self.trace_timeout = trace_timeout
+        self.metrics = TailSamplingMetrics(
+            metrics_factory or LegacyMetricsFactory(metrics or Metrics()))
+        self.lock = threading.Lock()
+        # buffered traces, least recently updated first
+        self._traces = OrderedDict()
+        self._size = 0
+        self._decisions = OrderedDict()
+        self._pid = os.getpid()
+        register_after_fork(self)
+
+    def _after_fork(self):
+        """
+        Start a forked child with an empty buffer. The lock may have been
+        held by another thread of the parent, and the parent decides the
+        traces it buffered itself.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.lock = threading.Lock()
+        self._traces = OrderedDict()
+        self._size = 0
+        self._decisions = OrderedDict()
+
+    def set_process(self, service_name, tags, max_length):
+        self.reporter.set_process(service_name, tags, max_length)
+
+    def report_span(self, span):
+        if not AT_FORK_SUPPORTED and self._pid != os.getpid():
+            self._after_fork()
+        now = monotonic()
+        trace_id = span.trace_id
+        is_root = not span.parent_id or \
+            span.kind == ext_tags.SPAN_KIND_RPC_SERVER
+        decided = []
+        with self.lock:
+            keep = self._decisions.get(trace_id)
+            if keep is None:
+                trace = self._traces.pop(trace_id, None)
+                if trace is None:
+                    trace = _TraceBuffer()
+                trace.spans.append(span)
+                trace.updated = now
+                self._size += self.span_overhead
+                if is_root:
+                    decided.append(self._decide(span, trace))
+                else:
+                    # re-inserted to move it to the end of the LRU order
+                    self._traces[trace_id] = trace
+                decided.extend(self._evict(now))
+        if keep is not None:
+            # finished after its trace was decided
+            decided.append((keep, [span]))
+        self._dispatch(decided)
+
+    def _evict(self, now):
+        """
+        Decide the least recently updated traces while the buffer is too
+        big or they timed out. Must be called while holding the lock.
+        """
+        evicted = []
+        deadline = now - self.trace_timeout
+        while self._traces:
+            trace = next(iter(self._traces.values()))
+            if self._size <= self.max_bytes and trace.updated > deadline:
+                break
+            self._traces.popitem(last=False)
+            self.metrics.traces_evicted(1)
+            evicted.append(self._decide(None, trace))
+        return evicted
+
+    def _decide(self, root, trace):
+        """
+        Apply the policies to a trace taken out of the buffer. Must be
+        called while holding the lock.
+
+        :return: Returns a (keep, spans) tuple.
+        """
+        spans = trace.spans
+        self._size -= len(spans) * self.span_overhead
+        keep = spans[0].is_sampled() or \
+            any(policy.keep(root, spans) for policy in self.policies)
+        self._decisions[spans[0].trace_id] = keep
+        if len(self._decisions) > _DECISION_CACHE_SIZE:
+            self._decisions.popitem(last=False)
+        return keep, spans
+
+    def _dispatch(self, decided):
+        for keep, spans in decided:
+            if keep:
+                self.metrics.spans_kept(len(spans))
+                for span in spans:
+                    self.reporter.report_span(span)
+            else:
+                self.metrics.spans_discarded(len(spans))
+                pool = spans[0].tracer.span_pool
+                if pool is not None:
+                    pool.release(spans)
+
+    def close(self, timeout=None):
+        """
+        Decide every buffered trace and close the wrapped reporter.
+
+        :return: Returns the future of the wrapped reporter's close().
+        """
+        with self.lock:
+            decided = [self._decide(None, trace)
+                       for trace in self._traces.values()]
+            self._traces.clear()
+        self._dispatch(decided)
+        return self.reporter.close(timeout)
+
+
+class TailSamplingMetrics(object):
+    def __init__(self, metrics_factory):
+        self.traces_evicted = \
+            metrics_factory.create_counter(name='algo.tail-sampling.evicted')
+        self.spans_kept = \
+            metrics_factory.create_counter(name='algo.spans', tags={'tail_sampled': 'true'})
+        self.spans_discarded = \
+            metrics_factory.create_counter(name='algo.spans', tags={'tail_sampled': 'false'})
@@ -14,6 +14,7 @@
 
 import six
 import socket
+import opentracing
 import struct
 
 _max_signed_port = (1 << 15) - 1
@@ -63,10 +64,28 @@ class SpanRefType(object):
 
 
 class Tag(object):
-  def __init__(self, key=None, vType=None, vStr=None):
+  def __init__(self, key=None, vType=None, vStr=None, vDouble=None,
+               vBool=None, vLong=None, vBinary=None):
     self.key = key
     self.vType = vType
     self.vStr = vStr
+    self.vDouble = vDouble
+    self.vBool = vBool
+    self.vLong = vLong
+    self.vBinary = vBinary
+
+
+class SpanRef(object):
+  def __init__(self, refType=None, traceId=None, spanId=None):
+    self.refType = refType
+    self.traceId = traceId
+    self.spanId = spanId
+
+
+class Process(object):
+  def __init__(self, serviceName=None, tags=None):
+    self.serviceName = serviceName
+    self.tags = tags
 
 
 def ipv4_to_int(ipv4):
@@ -94,7 +113,7 @@ def make_string_tag(key, value, max_length):
     if len(value) > max_length:
         value = value[:max_length]
     return Tag(key=key,
-        vType=str,
+        vType=TagType.STRING,
         vStr=value,
     )
 
@@ -111,10 +130,43 @@ def timestamp_micros(ts):
     return long(ts * 1000000)
 
 
+def tag_type(value):
+    """
+    :return: Returns the TagType a tag value is stored as. Integers that
+        do not fit in an i64 are stored as strings.
+    """
+    if isinstance(value, bool):
+        return TagType.BOOL
+    if isinstance(value, six.integer_types):
+        if -_max_signed_id - 1 <= value <= _max_signed_id:
+            return TagType.LONG
+        return TagType.STRING
+    if isinstance(value, float):
+        return TagType.DOUBLE
+    if isinstance(value, bytearray) or \
+            (six.PY3 and isinstance(value, bytes)):
+        return TagType.BINARY
+    return TagType.STRING
+
+
+def make_tag(key, value, max_length):
+    v_type = tag_type(value)
+    if v_type == TagType.BOOL:
+        return Tag(key=key, vType=v_type, vBool=value)
+    if v_type == TagType.LONG:
+        return Tag(key=key, vType=v_type, vLong=value)
+    if v_type == TagType.DOUBLE:
+        return Tag(key=key, vType=v_type, vDouble=value)
+    if v_type == TagType.BINARY:
+        return Tag(key=key, vType=v_type, vBinary=bytes(value[:max_length]))
+    if not isinstance(value, six.string_types):
+        value = six.text_type(value)
+    return make_string_tag(key=key, value=value, max_length=max_length)
+
+
 def make_tags(tags, max_length):
-    # TODO extend to support non-string tag values
     return [
-        make_string_tag(key=k, value=str(v), max_length=max_length)
+        make_tag(key=k, value=v, max_length=max_length)
         for k, v in six.iteritems(tags or {})
     ]
 
@@ -131,8 +183,14 @@ def make_log(timestamp, fields, max_length):
 #         fields=make_tags(tags=fields, max_length=max_length),
 #     )
 
-# def make_process(service_name, tags, max_length):
-#     return ttypes.Process(
-#         serviceName=service_name,
-#         tags=make_tags(tags=tags, max_length=max_length),
-#     )
+def make_ref_type(span_ref_type):
+    if span_ref_type == opentracing.ReferenceType.FOLLOWS_FROM:
+        return SpanRefType.FOLLOWS_FROM
+    return SpanRefType.CHILD_OF
+
+
+def make_process(service_name, tags, max_length):
+    return Process(
+        serviceName=service_name,
+        tags=make_tags(tags=tags, max_length=max_length),
+    )
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 from builtins import object
+import functools
 import socket
 import threading
 import logging
@@ -8,17 +9,26 @@ import os
 import random
 import time
 import six
+try:
+    from inspect import iscoroutinefunction
+except ImportError:  # Python 2
+    def iscoroutinefunction(func):
+        return False
 import opentracing
 from opentracing import Format, UnsupportedFormatException
 from opentracing.ext import tags as ext_tags
 
 from . import constants
 from .codecs import TextCodec,  BinaryCodec
-from .span import Span, SAMPLED_FLAG, DEBUG_FLAG
+from .span import Span, UnsampledSpan, SAMPLED_FLAG, DEBUG_FLAG, \
+    RECORD_FLAG, POOLING_SUPPORTED
 from .span_context import SpanContext
 from .thrift import ipv4_to_int
 from .metrics import Metrics, LegacyMetricsFactory
-from .utils import local_ip, ip2long, stagedb_future
+from .id_generator import RandomIdGenerator
+from .scope_manager import ThreadLocalScopeManager
+from .utils import local_ip, stagedb_future, \
+    AT_FORK_SUPPORTED, register_after_fork
 
 
 logger = logging.getLogger('algo_tracing')
@@ -36,8 +46,32 @@ class Tracer(opentracing.Tracer):
         debug_id_header=constants.DEBUG_ID_HEADER_KEY,
         one_span_per_rpc=False, extra_codecs=None,
         max_tag_value_length=constants.MAX_TAG_VALUE_LENGTH,
+        client_factory=None, id_generator=None,
+        generate_128bit_trace_id=False, span_pool=None, scope_manager=None,
+        log_error_stack=False, record_all=False,
     ):
+        """
+        :param client_factory: a callable that opens a new stagedb client,
+            used to replace the inherited client in a forked child process
+        :param id_generator: an IdGenerator for span IDs, defaults to
+            RandomIdGenerator
+        :param generate_128bit_trace_id: draw 128-bit instead of 64-bit
+            trace IDs
+        :param span_pool: a SpanPool to recycle reported spans through,
+            ignored where POOLING_SUPPORTED is False
+        :param scope_manager: the ScopeManager tracking the active span,
+            defaults to ThreadLocalScopeManager
+        :param log_error_stack: log the formatted traceback of an exception
+            raised in a scope's block along with its type and message
+        :param record_all: record and report the traces the sampler does
+            not sample as well, for a TailSamplingReporter to decide on.
+            Only the sampler's decision is propagated to other services,
+            which record unsampled traces joined from elsewhere too if
+            they are created with record_all
+        """
         self._algodb=client
+        self.client_factory = client_factory
+        self._pid = os.getpid()
         self.service_name = service_name
         self.reporter = reporter
         self.sampler = sampler
@@ -45,6 +79,13 @@ class Tracer(opentracing.Tracer):
         self.metrics_factory = metrics_factory or LegacyMetricsFactory(metrics or Metrics())
         self.metrics = TracerMetrics(self.metrics_factory)
         self.random = random.Random(time.time() * (os.getpid() or 1))
+        self.id_generator = id_generator or RandomIdGenerator()
+        self.span_pool = span_pool if POOLING_SUPPORTED else None
+        self.scope_manager = scope_manager or ThreadLocalScopeManager()
+        self.log_error_stack = log_error_stack
+        self.record_all = record_all
+        self.max_trace_id_bits = constants.MAX_TRACE_ID_BITS \
+            if generate_128bit_trace_id else constants.MAX_ID_BITS
         self.debug_id_header = debug_id_header
         self.one_span_per_rpc = one_span_per_rpc
         self.max_tag_value_length = max_tag_value_length
@@ -68,6 +109,9 @@ class Tracer(opentracing.Tracer):
         self.tags = {
             constants.ALGO_VERSION_TAG_KEY: constants.ALGO_CLIENT_VERSION,
         }
+        if self.service_name in constants.SERVICES:
+            self.tags[constants.ALGO_SERVICE_CODE_TAG_KEY] = \
+                constants.SERVICES[self.service_name]
         if tags:
             self.tags.update(tags)
         # noinspection PyBroadException
@@ -83,6 +127,21 @@ class Tracer(opentracing.Tracer):
             tags=self.tags,
             max_length=self.max_tag_value_length,
         )
+        register_after_fork(self)
+
+    def _after_fork(self):
+        """
+        Make a forked child independent of its parent: re-seed ID
+        generation, so that workers do not produce the same IDs, and open
+        a stagedb client of its own.
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.random = random.Random()  # seeded from os.urandom()
+        self.id_generator.reset()
+        if self.client_factory is not None:
+            self._algodb = self.client_factory()
 
     def start_span(self,
                    operation_name=None,
@@ -90,7 +149,8 @@ class Tracer(opentracing.Tracer):
                    references=None,
                    tags=None,
                    start_time=None,
-                   remote_addr=None):
+                   remote_addr=None,
+                   ignore_active_span=False):
         """
         Start and return a new Span representing a unit of work.
 
@@ -105,27 +165,56 @@ class Tracer(opentracing.Tracer):
             to avoid extra data copying.
         :param start_time: an explicit Span start time as a unix timestamp per
             time.time()
+        :param remote_addr: ignored, span IDs no longer derive from it
+        :param ignore_active_span: do not make the new span a child of the
+            active span when no parent is given
 
         :return: Returns an already-started Span instance.
         """
+        if not AT_FORK_SUPPORTED and self._pid != os.getpid():
+            self._after_fork()
         parent = child_of
-        if references:
-            if isinstance(references, list):
-                # TODO only the first reference is currently used
-                references = references[0]
-            parent = references.referenced_context
-
         # allow Span to be passed as reference, not just SpanContext
         if isinstance(parent, Span):
             parent = parent.context
 
+        valid_references = None
+        if references:
+            if not isinstance(references, list):
+                references = [references]
+            valid_references = []
+            for reference in references:
+                referenced = reference.referenced_context
+                if isinstance(referenced, Span):
+                    reference = opentracing.Reference(
+                        type=reference.type,
+                        referenced_context=referenced.context)
+                if reference.referenced_context is not None:
+                    valid_references.append(reference)
+            if parent is None and valid_references:
+                # the first CHILD_OF reference is the parent, else the first
+                parent = valid_references[0].referenced_context
+                for reference in valid_references:
+                    if reference.type == opentracing.ReferenceType.CHILD_OF:
+                        parent = reference.referenced_context
+                        break
+
+        if parent is None and not ignore_active_span:
+            scope = self.scope_manager.active
+            if scope is not None:
+                parent = scope.span.context
+
+        if parent is not None and parent.trace_id and not self.record_all and \
+                not parent.flags & (SAMPLED_FLAG | RECORD_FLAG) and \
+                not (tags and ext_tags.SAMPLING_PRIORITY in tags):
+            # unsampled trace: share the parent's context, record nothing
+            self.metrics.spans_not_sampled(1)
+            return UnsampledSpan(context=parent, tracer=self,
+                                 operation_name=operation_name)
+
         if parent is None or parent.is_debug_id_container_only:
-            tme=time.time()
-            ipl=ip2long(remote_addr if remote_addr else self.ip_address)
-            trace_id=constants.SERVICES.get(self.service_name,100)
-            # actions=constants.METHODS[self.service_name]
-            # oper_id=actions.index(operation_name)+1
-            span_id =int('%10.0f%010d'%(tme,ipl))
+            trace_id = self.random_id(self.max_trace_id_bits)
+            span_id = self.id_generator.new_id()
             parent_id = None
             flags = 0
             baggage = None
@@ -137,28 +226,122 @@ class Tracer(opentracing.Tracer):
                     tags = tags or {}
                     for k, v in six.iteritems(sampler_tags):
                         tags[k] = v
+                elif self.record_all:
+                    flags = RECORD_FLAG
             else:  # have debug id
                 flags = SAMPLED_FLAG | DEBUG_FLAG
                 tags = tags or {}
                 tags[self.debug_id_header] = parent.debug_id
         else:
             trace_id = parent.trace_id
-            span_id = parent.span_id
-            parent_id = parent.parent_id
+            if self.one_span_per_rpc and tags and tags.get(
+                    ext_tags.SPAN_KIND) == ext_tags.SPAN_KIND_RPC_SERVER:
+                # the server side of an RPC shares the client's span
+                span_id = parent.span_id
+                parent_id = parent.parent_id
+            else:
+                span_id = self.id_generator.new_id()
+                parent_id = parent.span_id
             flags = parent.flags
+            if self.record_all and not flags & SAMPLED_FLAG:
+                # joined from another service, which does not propagate it
+                flags |= RECORD_FLAG
             baggage = dict(parent.baggage)
 
         span_ctx = SpanContext(trace_id=trace_id, span_id=span_id,
                                parent_id=parent_id, flags=flags,
                                baggage=baggage)
-        span = Span(context=span_ctx, tracer=self,
-                    operation_name=operation_name,
-                    tags=tags, start_time=start_time)
+        if self.span_pool is not None:
+            span = self.span_pool.acquire(
+                context=span_ctx, tracer=self, operation_name=operation_name,
+                tags=tags, start_time=start_time, references=valid_references)
+        else:
+            span = Span(context=span_ctx, tracer=self,
+                        operation_name=operation_name,
+                        tags=tags, start_time=start_time,
+                        references=valid_references)
 
         self._emit_span_metrics(span=span, join=True)
 
         return span
 
+    def start_active_span(self,
+                          operation_name=None,
+                          child_of=None,
+                          references=None,
+                          tags=None,
+                          start_time=None,
+                          ignore_active_span=False,
+                          finish_on_close=True):
+        """
+        Start a span and make it the active span, the implicit parent of
+        spans started while it is active. Use the returned Scope as a
+        context manager:
+
+            with tracer.start_active_span('get_user') as scope:
+                scope.span.set_tag('user.id', user_id)
+
+        Arguments are those of start_span(), and
+
+        :param finish_on_close: finish the span when the scope is closed
+
+        :return: Returns the Scope of the new span.
+        """
+        span = self.start_span(
+            operation_name=operation_name, child_of=child_of,
+            references=references, tags=tags, start_time=start_time,
+            ignore_active_span=ignore_active_span)
+        return self.scope_manager.activate(span, finish_on_close)
+
+    @property
+    def active_span(self):
+        """
+        :return: Returns the active Span, or None.
+        """
+        scope = self.scope_manager.active
+        return scope.span if scope is not None else None
+
+    def trace(self, operation_name=None, tags=None):
+        """
+        Decorator running each call of a function in an active span:
+
+            @tracer.trace()
+            def get_user(user_id):
+                ...
+
+        Coroutine functions are supported on Python 3.7+, with the
+        ContextVarsScopeManager. Other scope managers share the active span
+        between the tasks of a thread, which would give the spans of
+        concurrent coroutines the wrong parents.
+
+        :param operation_name: name of the spans, defaults to the name of
+            the function
+        :param tags: tags set on every span
+        :raises ValueError: if a coroutine function is decorated while
+            the tracer uses another scope manager
+        """
+        def decorator(func):
+            name = operation_name or func.__name__
+            if iscoroutinefunction(func):
+                from .contextvars_scope_manager import \
+                    ContextVarsScopeManager, trace_coroutine
+                if not isinstance(self.scope_manager,
+                                  ContextVarsScopeManager):
+                    raise ValueError(
+                        'Tracing coroutine function %s requires the '
+                        'ContextVarsScopeManager, not %s' %
+                        (func.__name__, type(self.scope_manager).__name__))
+                return trace_coroutine(self, func, name, tags)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                # start_span() may add to the tags it is given
+                with self.start_active_span(
+                        name, tags=dict(tags) if tags else None):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
     def inject(self, span_context, format, carrier):
         codec = self.codecs.get(format, None)
         if codec is None:
@@ -169,6 +352,14 @@ class Tracer(opentracing.Tracer):
         if not isinstance(span_context, SpanContext):
             raise ValueError(
                 'Expecting Algo SpanContext, not %s', type(span_context))
+        if span_context.flags and span_context.flags & RECORD_FLAG:
+            # recording for tail sampling is local to this service
+            span_context = SpanContext(
+                trace_id=span_context.trace_id,
+                span_id=span_context.span_id,
+                parent_id=span_context.parent_id,
+                flags=span_context.flags & ~RECORD_FLAG,
+                baggage=span_context.baggage)
         codec.inject(span_context=span_context, carrier=carrier)
 
     def extract(self, format, carrier):
@@ -177,16 +368,19 @@ class Tracer(opentracing.Tracer):
             raise UnsupportedFormatException(format)
         return codec.extract(carrier)
 
-    def close(self):
+    def close(self, timeout=None):
         """
         Perform a clean shutdown of the tracer, flushing any traces that
         may be buffered in memory.
 
-        :return: Returns a concurrent.futures.Future that indicates if the
-            flush has been completed.
+        :param timeout: how long the reporter may take to flush, in seconds;
+            defaults to the reporter's close timeout
+        :return: Returns a concurrent.futures.Future that resolves to a
+            reporter.FlushResult with the number of spans flushed and
+            abandoned once the flush has been completed.
         """
         self.sampler.close()
-        return self.reporter.close()
+        return self.reporter.close(timeout=timeout)
 
     def _emit_span_metrics(self, span, join=False):
         if span.is_sampled():
@@ -209,8 +403,10 @@ class Tracer(opentracing.Tracer):
     def report_span(self, span):
         self.reporter.report_span(span)
 
-    def random_id(self):
-        return self.random.getrandbits(constants.MAX_ID_BITS)
+    def random_id(self, bits=constants.MAX_ID_BITS):
+        # trace IDs must be uniform for the probabilistic sampler, so they
+        # are drawn here rather than from the span IdGenerator
+        return self.random.getrandbits(bits) or 1
 
     def insert(self, key, value):
         script = '''
@@ -235,14 +431,12 @@ else:
         for key in sets:
             value=str(sets[key])
             func=wrapper()
-            print type(key),type(value),type(func)
             self._algodb.async_put(str(key), value, func)
         return event_list
 
 
     def field_future(self,key,func=None):
         field=stagedb_future(func)
-        print type(field.on_finish)
         self._algodb.async_get(str(key), field.on_finish)
         return field
 
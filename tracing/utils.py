@@ -15,10 +15,13 @@ from builtins import bytes
 from builtins import range
 from builtins import object
 import fcntl
+import os
 import socket
 import struct
+import sys
 import time
 import threading
+import weakref
 
 class stagedb_future:
     def __init__(self, func):
@@ -50,6 +53,98 @@ class stagedb_future:
     def __repr__(self):
         return self.__str__()
 
+_after_fork_objects = weakref.WeakSet()
+
+
+def register_after_fork(obj):
+    """
+    Arrange for obj._after_fork() to be called in the child process after
+    os.fork(), as long as obj is alive.
+
+    Pythons before 3.7 have no fork hooks and AT_FORK_SUPPORTED is False;
+    the object then has to notice the changed os.getpid() itself.
+    """
+    _after_fork_objects.add(obj)
+
+
+def _run_after_fork():
+    for obj in list(_after_fork_objects):
+        obj._after_fork()
+
+
+AT_FORK_SUPPORTED = hasattr(os, 'register_at_fork')
+if AT_FORK_SUPPORTED:
+    os.register_at_fork(after_in_child=_run_after_fork)
+
+
+def _libc_monotonic_ns():
+    """
+    Build a monotonic_ns() on clock_gettime(CLOCK_MONOTONIC), for Pythons
+    before 3.3 on Linux.
+
+    :return: Returns None if clock_gettime() is not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    clock_monotonic = 1
+
+    def monotonic_ns():
+        ts = timespec()
+        clock_gettime(clock_monotonic, ctypes.byref(ts))
+        return ts.tv_sec * 1000000000 + ts.tv_nsec
+    return monotonic_ns
+
+
+# monotonic_ns() returns a clock in integer nanoseconds and monotonic() the
+# same clock in float seconds. They are only good for measuring intervals;
+# without a monotonic clock they fall back to the wall clock.
+if hasattr(time, 'monotonic_ns'):
+    monotonic_ns = time.monotonic_ns
+    monotonic = time.monotonic
+elif hasattr(time, 'monotonic'):
+    monotonic = time.monotonic
+
+    def monotonic_ns():
+        return int(time.monotonic() * 1000000000)
+else:
+    monotonic_ns = _libc_monotonic_ns() or \
+        (lambda: int(time.time() * 1000000000))
+
+    def monotonic():
+        return monotonic_ns() / 1000000000.0
+
+
+try:
+    from asyncio import get_running_loop
+except ImportError:  # Python 2 and 3.6
+    get_running_loop = None
+
+
+def in_event_loop():
+    """
+    :return: Returns True if called from a running asyncio event loop, which
+        must never be blocked. Always False before Python 3.7.
+    """
+    if get_running_loop is None:
+        return False
+    try:
+        get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
 class ErrorReporter(object):
     """
     Reports errors by emitting metrics, and if logger is provided,
@@ -61,7 +156,7 @@ class ErrorReporter(object):
     def __init__(self, logger=None, log_interval_minutes=15):
         self.logger = logger
         self.log_interval_minutes = log_interval_minutes
-        self._last_error_reported_at = time.time()
+        self._last_error_reported_at = monotonic()
 
     def error(self, *args):
         if self.logger is None:
@@ -69,7 +164,7 @@ class ErrorReporter(object):
 
         next_logging_deadline = \
             self._last_error_reported_at + (self.log_interval_minutes * 60)
-        current_time = time.time()
+        current_time = monotonic()
         if next_logging_deadline >= current_time:
             # If we aren't yet at the next logging deadline
             return